@@ -0,0 +1,167 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Nova Billing
+# Copyright (C) 2010-2012 Grid Dynamics Consulting Services, Inc
+# All Rights Reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Caches of the Heart.
+"""
+
+import time
+import bisect
+import weakref
+import datetime
+
+from nova_billing import utils
+
+
+class Snapshot(object):
+    """
+    Earliest datetime touched since the snapshot was taken
+    (``None`` if nothing was touched).
+    """
+
+    def __init__(self):
+        self.touched_at = None
+
+
+class ReportCache(object):
+    """
+    LRU cache of reports on periods that are already over.
+    Reports are kept as JSON strings not longer than ``item_size``.
+
+    Writes report the earliest datetime they touch with :meth:`touch`,
+    and cached reports on periods ending after it are dropped.
+    Writes of other processes are not seen, so reports also
+    expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, size, item_size, ttl):
+        self.reports = utils.LRUCache(size)
+        self.item_size = item_size
+        self.ttl = ttl
+        # sorted period ends and cache keys by period end;
+        # keys evicted from ``reports`` are pruned lazily
+        self.period_ends = []
+        self.keys_by_end = {}
+        self.indexed = 0
+        self.snapshots = weakref.WeakSet()
+
+    @staticmethod
+    def key(version, period_start, period_end, filter):
+        return (period_end, period_start, version,
+                tuple(sorted(filter.iteritems())))
+
+    def get(self, key):
+        item = self.reports.get(key)
+        if item is None:
+            return None
+        cached_at, report = item
+        if time.time() - cached_at > self.ttl:
+            del self.reports[key]
+            return None
+        return report
+
+    def snapshot(self):
+        """
+        Start tracking writes for a report that is about to be built.
+        """
+        snapshot = Snapshot()
+        self.snapshots.add(snapshot)
+        return snapshot
+
+    def put(self, key, snapshot, report):
+        """
+        Save ``report`` if its period is over and no write
+        since ``snapshot`` touched the period.
+        """
+        self.snapshots.discard(snapshot)
+        period_end = key[0]
+        if period_end > utils.now():
+            return
+        if (snapshot.touched_at is not None and
+                snapshot.touched_at < period_end):
+            return
+        if key not in self.reports:
+            self.index(key)
+        self.reports[key] = (time.time(), report)
+
+    def index(self, key):
+        if self.indexed >= 2 * max(self.reports.size, 1):
+            self.reindex()
+        period_end = key[0]
+        keys = self.keys_by_end.get(period_end)
+        if keys is None:
+            keys = self.keys_by_end[period_end] = set()
+            bisect.insort(self.period_ends, period_end)
+        if key not in keys:
+            keys.add(key)
+            self.indexed += 1
+
+    def reindex(self):
+        self.period_ends = []
+        self.keys_by_end = {}
+        self.indexed = 0
+        for key in self.reports.keys():
+            self.keys_by_end.setdefault(key[0], set()).add(key)
+            self.indexed += 1
+        self.period_ends = sorted(self.keys_by_end)
+
+    def collect(self, key, snapshot, chunks):
+        """
+        Pass through ``chunks`` of the report and save it
+        if it is not too long.
+        """
+        saved = []
+        saved_size = 0
+        for chunk in chunks:
+            if saved is not None:
+                saved_size += len(chunk)
+                if saved_size > self.item_size:
+                    saved = None
+                else:
+                    saved.append(chunk)
+            yield chunk
+        if saved is not None:
+            self.put(key, snapshot, "".join(saved))
+
+    def touch(self, touched_at=None):
+        """
+        Register a write of data at ``touched_at``
+        (``None`` means that all reports could change).
+        """
+        if touched_at is None:
+            touched_at = datetime.datetime.min
+        for snapshot in self.snapshots:
+            if (snapshot.touched_at is None or
+                    touched_at < snapshot.touched_at):
+                snapshot.touched_at = touched_at
+        pos = bisect.bisect_right(self.period_ends, touched_at)
+        for period_end in self.period_ends[pos:]:
+            for key in self.keys_by_end.pop(period_end):
+                self.reports.pop(key)
+                self.indexed -= 1
+        del self.period_ends[pos:]
+
+    def clear(self):
+        self.reports.clear()
+        self.period_ends = []
+        self.keys_by_end = {}
+        self.indexed = 0
+        self.snapshots.clear()
@@ -19,12 +19,92 @@
 # <http://www.gnu.org/licenses/>.
 
 
+import sqlite3
+import threading
+from functools import partial
+
 from flask import Flask
-from flaskext.sqlalchemy import SQLAlchemy
+from flaskext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
 
 from nova_billing.heart import app
 from nova_billing.utils import global_conf
 
 
+# whether queries of the current thread may go to heart_db_read_uri
+routing = threading.local()
+
+
+class RoutingSession(_SignallingSession):
+    """
+    Session sending all queries to the ``read`` bind
+    while ``routing.read_only`` is set.
+    """
+
+    def get_bind(self, mapper, clause=None):
+        if getattr(routing, "read_only", False) and global_conf.heart_db_read_uri:
+            return db.get_engine(self.app, "read")
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class HeartSQLAlchemy(SQLAlchemy):
+
+    def create_scoped_session(self, options=None):
+        return orm.scoped_session(
+            partial(RoutingSession, self, **(options or {})))
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername.startswith("sqlite"):
+            # SQLite pools are not sized
+            options.pop("pool_size", None)
+            options.pop("pool_timeout", None)
+        elif global_conf.heart_db_max_overflow is not None:
+            options["max_overflow"] = global_conf.heart_db_max_overflow
+
+
 app.config['SQLALCHEMY_DATABASE_URI'] = global_conf.heart_db_uri
-db = SQLAlchemy(app)
+app.config['SQLALCHEMY_POOL_SIZE'] = global_conf.heart_db_pool_size
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = global_conf.heart_db_pool_timeout
+app.config['SQLALCHEMY_POOL_RECYCLE'] = global_conf.heart_db_pool_recycle
+if global_conf.heart_db_read_uri:
+    app.config['SQLALCHEMY_BINDS'] = {"read": global_conf.heart_db_read_uri}
+db = HeartSQLAlchemy(app)
+
+
+def read_engine():
+    """
+    Engine for queries that may go to heart_db_read_uri.
+    """
+    if getattr(routing, "read_only", False) and global_conf.heart_db_read_uri:
+        return db.get_engine(app, "read")
+    return db.engine
+
+
+if global_conf.heart_db_pre_ping:
+    @event.listens_for(Pool, "checkout")
+    def ping_connection(dbapi_connection, connection_record, connection_proxy):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except:
+            # the pool will reconnect and retry
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+
+# pysqlite begins and commits transactions on its own and breaks
+# savepoints, so let SQLAlchemy emit BEGIN itself
+@event.listens_for(Engine, "connect")
+def sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, "begin")
+def sqlite_begin(connection):
+    if connection.engine.dialect.name == "sqlite":
+        connection.execute("BEGIN")
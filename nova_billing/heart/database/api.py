@@ -23,16 +23,910 @@
 Nova Billing API.
 """
 
-from itertools import repeat
-from datetime import datetime
+import heapq
+import threading
+import contextlib
+import time as time_mod
 
-from sqlalchemy.sql import func, and_, or_
-from sqlalchemy.sql.expression import text
+from itertools import repeat, groupby
+from operator import itemgetter
+from datetime import date, datetime, time, timedelta
 
-from .models import CostCenter, Account, Resource, Segment, Tariff
-from . import db
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy import DateTime, Float
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import func, and_, or_, not_, select
+from sqlalchemy.sql.expression import text, case, literal, null, \
+     union_all, FunctionElement
+
+from .models import CostCenter, Account, Resource, Segment, OpenSegment, \
+     SegmentArchive, Tariff, CostRollup, RolledSegment, CostBreakpoint, \
+     Counter, segment_archive_table
+from . import db, routing, read_engine
 
 from nova_billing import utils
+from nova_billing.utils import global_conf
+
+
+class seconds_between(FunctionElement):
+    """
+    Whole seconds between two datetimes rounded down
+    like :func:`nova_billing.utils.total_seconds` does.
+    """
+    type = Float()
+    name = "seconds_between"
+
+
+@compiles(seconds_between)
+def _seconds_between_default(element, compiler, **kw):
+    begin_at, end_at = [compiler.process(clause)
+                        for clause in element.clauses]
+    return "FLOOR(EXTRACT(EPOCH FROM (%s - %s)))" % (end_at, begin_at)
+
+
+@compiles(seconds_between, "mysql")
+def _seconds_between_mysql(element, compiler, **kw):
+    begin_at, end_at = [compiler.process(clause)
+                        for clause in element.clauses]
+    return "FLOOR(TIMESTAMPDIFF(MICROSECOND, %s, %s) / 1000000)" % (
+        begin_at, end_at)
+
+
+@compiles(seconds_between, "sqlite")
+def _seconds_between_sqlite(element, compiler, **kw):
+    # SQLAlchemy stores datetimes in SQLite as
+    # "YYYY-MM-DD HH:MM:SS.ffffff", so microseconds start at 21.
+    # strftime rounds fractional seconds, hence they are cut off first.
+    # Every argument is compiled once per occurrence in order to
+    # keep positional parameters in place.
+    begin_at, end_at = list(element.clauses)
+    return ("(CAST(strftime('%%s', substr(%s, 1, 19)) AS INTEGER)"
+            " - CAST(strftime('%%s', substr(%s, 1, 19)) AS INTEGER)"
+            " - (CAST(substr(%s, 21, 6) AS INTEGER)"
+            " < CAST(substr(%s, 21, 6) AS INTEGER)))" %
+            tuple(compiler.process(clause)
+                  for clause in (end_at, begin_at, end_at, begin_at)))
+
+
+def iter_queries(queries, batch_size=1000):
+    """
+    Iterate over rows of ``queries`` fetching them by portions
+    of ``batch_size``, so that rows are not loaded in memory all at once.
+    The queries run in one transaction on a separate connection
+    that is closed when all their rows are read.
+
+    The queries are executed lazily and can outlive the request.
+
+    :returns: a list of row iterators, one per query.
+    """
+    statements = [query.statement for query in queries]
+    engine = read_engine()
+    state = {"results": None, "running": len(statements)}
+
+    def execute():
+        connection = engine.connect()
+        state["connection"] = connection
+        state["transaction"] = connection.begin()
+        connection = connection.execution_options(stream_results=True)
+        state["results"] = [connection.execute(statement)
+                            for statement in statements]
+
+    def rows(index):
+        try:
+            if state["results"] is None:
+                execute()
+            result = state["results"][index]
+            while True:
+                batch = result.fetchmany(batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    yield row
+        finally:
+            state["running"] -= 1
+            if not state["running"] and "connection" in state:
+                try:
+                    state["transaction"].rollback()
+                finally:
+                    state["connection"].close()
+
+    return [rows(index) for index in xrange(len(statements))]
+
+
+def iter_query(query, batch_size=1000):
+    """
+    Iterate over rows of ``query`` like :func:`iter_queries` does.
+    """
+    return iter_queries([query], batch_size)[0]
+
+
+def apply_resource_filter(query, filter):
+    for attr in "account_id", "cost_center_id":
+        if attr in filter:
+            query = query.filter(getattr(Resource, attr) == filter[attr])
+    return query
+
+
+def resource_descr(rsrc, cost=0.0, min_start=None,
+                   max_start=None, max_stop=None):
+    return {
+        "id": rsrc.id,
+        "created_at": min_start,
+        "destroyed_at": (max_stop
+                         if max_stop is None or max_start < max_stop
+                         else None),
+        "cost": cost,
+        "parent_id": rsrc.parent_id,
+        "name": rsrc.name,
+        "rtype": rsrc.rtype,
+    }
+
+
+def archived_segments(period_start=None, period_stop=None):
+    """
+    Selectable of segments from archive months that may overlap
+    [``period_start``, ``period_stop``), by default from all of them.
+
+    :returns: the selectable or None if no archive month matches.
+    """
+    query = SegmentArchive.query
+    if period_start is not None:
+        query = query.filter(SegmentArchive.max_end_at > period_start)
+    if period_stop is not None:
+        query = query.filter(SegmentArchive.min_begin_at < period_stop)
+    tables = [segment_archive_table(archive.month)
+              for archive in query.order_by(SegmentArchive.month)]
+    if not tables:
+        return None
+    return union_all(*[table.select() for table in tables]).alias(
+        "archived_segment")
+
+
+def segment_inverted(segments=Segment.__table__):
+    """
+    Condition of segments ended before their beginning by a late event.
+    Such a segment costs ``cost * (end_at - begin_at)`` in periods
+    containing both its ends and nothing in other periods,
+    which cannot be split into days or breakpoints.
+    """
+    return segments.c.end_at < segments.c.begin_at
+
+
+def segment_sources(period_start, period_stop):
+    """
+    Segment tables to read for the period: ``segment`` and
+    the overlapping archive months.
+    """
+    archive = archived_segments(period_start, period_stop)
+    if archive is None:
+        return [Segment.__table__]
+    return [Segment.__table__, archive]
+
+
+def bill_on_interval_python(period_start, period_stop, filter, now):
+    """
+    Compute the bill in Python loading every segment of the interval.
+    """
+    retval = {}
+    rsrc_by_id = {}
+    bounds = {}
+    for segments in segment_sources(period_start, period_stop):
+        result = apply_resource_filter(db.session.query(
+            segments.c.cost, segments.c.begin_at, segments.c.end_at,
+            Resource).
+            select_from(segments).
+            join(Resource, Resource.id == segments.c.resource_id).
+            filter(segments.c.begin_at < period_stop).
+            filter(or_(segments.c.end_at > period_start,
+                       segments.c.end_at == None)), filter)
+
+        for cost, segment_begin_at, segment_end_at, rsrc in result:
+            if not retval.has_key(rsrc.account_id):
+                retval[rsrc.account_id] = []
+            try:
+                rsrc_descr = rsrc_by_id[rsrc.id]
+            except KeyError:
+                rsrc_descr = resource_descr(rsrc)
+                retval[rsrc.account_id].append(rsrc_descr)
+                rsrc_by_id[rsrc.id] = rsrc_descr
+                bounds[rsrc.id] = [segment_begin_at, segment_begin_at, None]
+            begin_at = max(segment_begin_at, period_start)
+            end_at = min(segment_end_at or now, period_stop)
+            rsrc_descr["cost"] += utils.cost_add(cost, begin_at, end_at)
+
+            rsrc_bounds = bounds[rsrc.id]
+            rsrc_bounds[0] = min(rsrc_bounds[0], segment_begin_at)
+            rsrc_bounds[1] = max(rsrc_bounds[1], segment_begin_at)
+            if segment_end_at is not None and (
+                    rsrc_bounds[2] is None or rsrc_bounds[2] < segment_end_at):
+                rsrc_bounds[2] = segment_end_at
+
+    for rsrc_id, (min_start, max_start, max_stop) in bounds.iteritems():
+        rsrc_descr = rsrc_by_id[rsrc_id]
+        rsrc_descr["created_at"] = min_start
+        if max_stop is None or max_start < max_stop:
+            rsrc_descr["destroyed_at"] = max_stop
+
+    return sorted(retval.iteritems())
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def datetime_to_us(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def us_to_datetime(value):
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def bill_on_interval_numpy(period_start, period_stop, filter, now):
+    """
+    Compute the bill with NumPy. Segment columns are loaded into arrays,
+    and costs are clipped, computed, and summed per resource without
+    a Python loop. Falls back to :func:`bill_on_interval_python`
+    if NumPy is not installed.
+    """
+    if numpy is None:
+        return bill_on_interval_python(period_start, period_stop, filter, now)
+    rows = []
+    for segments in segment_sources(period_start, period_stop):
+        rows.extend(apply_resource_filter(db.session.query(
+            segments.c.resource_id, segments.c.cost,
+            segments.c.begin_at, segments.c.end_at).
+            select_from(segments).
+            join(Resource, Resource.id == segments.c.resource_id).
+            filter(segments.c.begin_at < period_stop).
+            filter(or_(segments.c.end_at > period_start,
+                       segments.c.end_at == None)), filter))
+    if not rows:
+        return []
+
+    resource_ids, costs, begins, ends = zip(*rows)
+    costs = numpy.array(costs, dtype=numpy.float64)
+    begins = numpy.array(begins, dtype="datetime64[us]").astype(numpy.int64)
+    ends = numpy.array(ends, dtype="datetime64[us]")
+    is_open = numpy.isnat(ends)
+    ends = ends.astype(numpy.int64)
+
+    # see utils.cost_add: linear costs are charged for whole seconds
+    seconds = (numpy.minimum(numpy.where(is_open, datetime_to_us(now), ends),
+                             datetime_to_us(period_stop)) -
+               numpy.maximum(begins, datetime_to_us(period_start))) // 10 ** 6
+    costs = numpy.where(costs < 0, costs,
+                        costs * seconds / utils.YEAR_SECONDS)
+
+    ids, groups = numpy.unique(resource_ids, return_inverse=True)
+    total_costs = numpy.bincount(groups, weights=costs, minlength=len(ids))
+    int64_info = numpy.iinfo(numpy.int64)
+    min_starts = numpy.full(len(ids), int64_info.max, dtype=numpy.int64)
+    numpy.minimum.at(min_starts, groups, begins)
+    max_starts = numpy.full(len(ids), int64_info.min, dtype=numpy.int64)
+    numpy.maximum.at(max_starts, groups, begins)
+    max_stops = numpy.full(len(ids), int64_info.min, dtype=numpy.int64)
+    numpy.maximum.at(max_stops, groups,
+                     numpy.where(is_open, int64_info.min, ends))
+
+    ids = ids.tolist()
+    resources = {}
+    for start in xrange(0, len(ids), 500):
+        for rsrc in Resource.query.filter(
+                Resource.id.in_(ids[start:start + 500])):
+            resources[rsrc.id] = rsrc
+
+    retval = {}
+    for index, rsrc_id in enumerate(ids):
+        rsrc = resources[rsrc_id]
+        max_stop = max_stops[index]
+        retval.setdefault(rsrc.account_id, []).append(resource_descr(
+            rsrc, float(total_costs[index]),
+            us_to_datetime(min_starts[index]),
+            us_to_datetime(max_starts[index]),
+            None if max_stop == int64_info.min else us_to_datetime(max_stop)))
+    return sorted(retval.iteritems())
+
+
+def clipped_cost_expr(cost, begin_at, end_at, period_start):
+    begin_at = case([(begin_at > period_start, begin_at)],
+                    else_=literal(period_start, DateTime))
+    return case([(cost < 0, cost)],
+                else_=cost * seconds_between(begin_at, end_at) /
+                utils.YEAR_SECONDS)
+
+
+def segment_cost_expr(period_start, period_stop, now,
+                      segments=Segment.__table__):
+    """
+    SQL expression for the segment cost clipped to
+    [``period_start``, ``period_stop``] (see :func:`utils.cost_add`).
+    """
+    end_at = case([(segments.c.end_at == None,
+                    literal(min(now, period_stop), DateTime)),
+                   (segments.c.end_at < period_stop, segments.c.end_at)],
+                  else_=literal(period_stop, DateTime))
+    return clipped_cost_expr(segments.c.cost, segments.c.begin_at, end_at,
+                             period_start)
+
+
+def open_segment_cost_expr(period_start, period_stop, now):
+    """
+    Like :func:`segment_cost_expr` for :class:`OpenSegment`.
+    """
+    return clipped_cost_expr(OpenSegment.cost, OpenSegment.begin_at,
+                             literal(min(now, period_stop), DateTime),
+                             period_start)
+
+
+def resource_aggregate_query(filter, cost, min_start, max_start, max_stop):
+    """
+    Query of resources with the given aggregates grouped by resource.
+    The caller joins the aggregated table.
+    """
+    return apply_resource_filter(db.session.query(
+        Resource.id,
+        Resource.account_id,
+        Resource.parent_id,
+        Resource.name,
+        Resource.rtype,
+        func.sum(cost).label("cost"),
+        func.min(min_start).label("min_start"),
+        func.max(max_start).label("max_start"),
+        func.max(max_stop).label("max_stop")).
+        group_by(Resource.id, Resource.account_id, Resource.parent_id,
+                 Resource.name, Resource.rtype).
+        order_by(Resource.account_id, Resource.id), filter)
+
+
+def segment_aggregate_query(period_start, period_stop, filter, cost,
+                            segments=Segment.__table__):
+    """
+    Aggregates of closed segments overlapping the period.
+    """
+    return (resource_aggregate_query(
+        filter, cost, segments.c.begin_at, segments.c.begin_at,
+        segments.c.end_at).
+        join(segments, segments.c.resource_id == Resource.id).
+        filter(segments.c.begin_at < period_stop).
+        filter(segments.c.end_at > period_start))
+
+
+def open_segment_aggregate_query(period_start, period_stop, filter, now):
+    """
+    Aggregates of open segments begun before the period end.
+    """
+    return (resource_aggregate_query(
+        filter, open_segment_cost_expr(period_start, period_stop, now),
+        OpenSegment.begin_at, OpenSegment.begin_at, null()).
+        join(OpenSegment, OpenSegment.resource_id == Resource.id).
+        filter(OpenSegment.begin_at < period_stop))
+
+
+def bill_from_rows(*row_lists):
+    """
+    Build the bill from aggregated rows ordered by account
+    and resource ids. Rows of the same resource coming from
+    different lists are merged. Rows are read lazily.
+    """
+    keyed = [(((row.account_id, row.id), index, row) for row in rows)
+             for index, rows in enumerate(row_lists)]
+
+    def resources():
+        for key, group in groupby(heapq.merge(*keyed), itemgetter(0)):
+            aggr = None
+            for _, _, row in group:
+                if aggr is None:
+                    aggr = [row, row.cost or 0.0, row.min_start,
+                            row.max_start, row.max_stop]
+                    continue
+                aggr[1] += row.cost or 0.0
+                aggr[2] = min(aggr[2], row.min_start)
+                aggr[3] = max(aggr[3], row.max_start)
+                if aggr[4] is None or (row.max_stop is not None and
+                                       aggr[4] < row.max_stop):
+                    aggr[4] = row.max_stop
+            yield aggr
+
+    return ((account_id, [resource_descr(*aggr) for aggr in account_aggrs])
+            for account_id, account_aggrs in groupby(
+                resources(), lambda aggr: aggr[0].account_id))
+
+
+def bill_on_interval_sql(period_start, period_stop, filter, now):
+    """
+    Compute the bill with grouped queries returning a row per
+    resource: one on closed segments, one on the archive months
+    overlapping the period, and one on open segments.
+    Rows are fetched by portions in one transaction.
+    """
+    queries = [segment_aggregate_query(
+                   period_start, period_stop, filter,
+                   segment_cost_expr(period_start, period_stop, now, segments),
+                   segments)
+               for segments in segment_sources(period_start, period_stop)]
+    queries.append(open_segment_aggregate_query(
+        period_start, period_stop, filter, now))
+    return bill_from_rows(*iter_queries(queries))
+
+
+def bill_on_interval_rollup(period_start, period_stop, filter, now):
+    """
+    Compute the bill summing whole days from the daily cost rollup.
+    Raw segments are read only for the partial days at the period edges
+    and for segments that are not rolled up yet (including open ones).
+    """
+    first_day = ((period_start - timedelta(microseconds=1)).date() +
+                 timedelta(days=1))
+    last_day = period_stop.date()
+    if first_day >= last_day:
+        return bill_on_interval_sql(period_start, period_stop, filter, now)
+    days_start = datetime.combine(first_day, time())
+    days_stop = datetime.combine(last_day, time())
+
+    rollup_rows = (resource_aggregate_query(
+        filter, CostRollup.cost, CostRollup.min_start,
+        CostRollup.max_start, CostRollup.max_stop).
+        join(CostRollup, CostRollup.resource_id == Resource.id).
+        filter(CostRollup.day >= first_day).
+        filter(CostRollup.day < last_day))
+
+    def segment_rows(segments, not_rolled):
+        edges_cost = (
+            case([(segments.c.begin_at < days_start,
+                   segment_cost_expr(period_start, days_start, now,
+                                     segments))],
+                 else_=0.0) +
+            case([(segments.c.end_at > days_stop,
+                   segment_cost_expr(days_stop, period_stop, now,
+                                     segments))],
+                 else_=0.0))
+        return (segment_aggregate_query(
+            period_start, period_stop, filter,
+            case([(not_rolled,
+                   segment_cost_expr(period_start, period_stop, now,
+                                     segments))],
+                 else_=edges_cost), segments).
+            filter(or_(not_rolled,
+                       segments.c.begin_at <= days_start,
+                       segments.c.end_at >= days_stop)))
+
+    not_rolled = or_(RolledSegment.segment_id == None, segment_inverted())
+    queries = [rollup_rows,
+               segment_rows(Segment.__table__, not_rolled).
+                   outerjoin(RolledSegment,
+                             RolledSegment.segment_id == Segment.id)]
+    archive = archived_segments(period_start, period_stop)
+    if archive is not None:
+        # linear segments are rolled up before they are archived
+        queries.append(segment_rows(
+            archive, or_(archive.c.cost < 0, segment_inverted(archive))))
+    queries.append(open_segment_aggregate_query(
+        period_start, period_stop, filter, now))
+    return bill_from_rows(*iter_queries(queries))
+
+
+def rollup_segments(limit=1000):
+    """
+    Add up to ``limit`` closed segments that are not rolled up yet
+    to the daily cost rollup. Fixed cost segments are never rolled up
+    since their cost does not depend on the period length,
+    nor are inverted segments (see :func:`segment_inverted`).
+
+    :returns: the number of rolled up segments.
+    """
+    segments = (Segment.query.
+        outerjoin(RolledSegment, RolledSegment.segment_id == Segment.id).
+        filter(RolledSegment.segment_id == None).
+        filter(Segment.end_at != None).
+        filter(Segment.cost >= 0).
+        filter(not_(segment_inverted())).
+        order_by(Segment.id).
+        limit(limit).all())
+
+    rollups = {}
+    for segment in segments:
+        day = segment.begin_at.date()
+        while True:
+            day_start = datetime.combine(day, time())
+            if day_start >= segment.end_at:
+                break
+            day_stop = day_start + timedelta(days=1)
+            cost = utils.cost_add(segment.cost,
+                                  max(segment.begin_at, day_start),
+                                  min(segment.end_at, day_stop))
+            key = (segment.resource_id, day)
+            try:
+                aggr = rollups[key]
+            except KeyError:
+                aggr = db.session.query(CostRollup).get(key)
+                if aggr is None:
+                    aggr = CostRollup(
+                        resource_id=segment.resource_id, day=day,
+                        cost=0.0,
+                        min_start=segment.begin_at,
+                        max_start=segment.begin_at,
+                        max_stop=segment.end_at)
+                    db.session.add(aggr)
+                rollups[key] = aggr
+            aggr.cost += cost
+            aggr.min_start = min(aggr.min_start, segment.begin_at)
+            aggr.max_start = max(aggr.max_start, segment.begin_at)
+            aggr.max_stop = max(aggr.max_stop, segment.end_at)
+            day += timedelta(days=1)
+        db.session.add(RolledSegment(segment_id=segment.id))
+
+    db.session.commit()
+    return len(segments)
+
+
+def breakpoints_enabled():
+    return global_conf.report_engine == "integral"
+
+
+def breakpoints_rebuild(resource_id):
+    """
+    Recompute all breakpoints of the resource from its segments,
+    including archived ones. Inverted segments (see :func:`segment_inverted`)
+    last no time here; their cost is added by the ``integral`` engine.
+    """
+    db.session.flush()
+    CostBreakpoint.query.filter_by(resource_id=resource_id).delete()
+    # segments are closed with bulk updates, so read rows, not objects
+    segments = []
+    for table in Segment.__table__, archived_segments():
+        if table is not None:
+            segments.extend(db.session.execute(table.select().where(
+                table.c.resource_id == resource_id)).fetchall())
+    begun = {}
+    ended = {}
+    end_ats = {}
+    inverted = set()
+    for segment in segments:
+        begun.setdefault(segment.begin_at, []).append(segment)
+        if segment.end_at is not None:
+            end_at = segment.end_at
+            if end_at < segment.begin_at:
+                end_at = segment.begin_at
+                inverted.add(segment.id)
+            end_ats[segment.id] = end_at
+            ended.setdefault(end_at, []).append(segment)
+
+    cost = rate = fixed_begun = fixed_ended = 0.0
+    max_start = max_stop = prev_at = None
+    active = {}
+    for at in sorted(set(begun) | set(ended)):
+        if prev_at is not None:
+            cost += utils.cost_add(rate, prev_at, at)
+        for segment in begun.get(at, ()):
+            if segment.cost < 0 and segment.id not in inverted:
+                fixed_begun += segment.cost
+            end_at = end_ats.get(segment.id)
+            if end_at is not None and (max_stop is None or max_stop < end_at):
+                max_stop = end_at
+            max_start = at
+            active[segment.id] = segment
+        for segment in ended.get(at, ()):
+            if segment.cost < 0 and segment.id not in inverted:
+                fixed_ended += segment.cost
+            active.pop(segment.id, None)
+        rate = 0.0
+        for segment in active.itervalues():
+            if segment.cost >= 0:
+                rate += segment.cost
+        db.session.add(CostBreakpoint(
+            resource_id=resource_id, at=at, cost=cost, rate=rate,
+            fixed_begun=fixed_begun, fixed_ended=fixed_ended,
+            max_start=max_start,
+            min_active_start=min([segment.begin_at
+                                  for segment in active.itervalues()] or
+                                 [None]),
+            max_stop=max_stop))
+        prev_at = at
+
+
+def breakpoints_update(closed_ids, segments, at):
+    """
+    Add breakpoints for an event at ``at`` that closed open segments
+    of ``closed_ids`` and opened ``segments``. Resources having
+    breakpoints later than ``at`` are rebuilt from their segments.
+
+    Breakpoints are kept only for the ``integral`` report engine.
+    """
+    if not breakpoints_enabled():
+        return
+    closed_ids = set(closed_ids)
+    opened = {}
+    for segment in segments:
+        opened.setdefault(segment.resource_id, []).append(segment)
+    db.session.flush()
+
+    for resource_id in closed_ids | set(opened):
+        prev = (CostBreakpoint.query.filter_by(resource_id=resource_id).
+                order_by(CostBreakpoint.at.desc()).first())
+        if prev is not None and prev.at > at:
+            breakpoints_rebuild(resource_id)
+            continue
+        closing = (resource_id in closed_ids and prev is not None and
+                   prev.min_active_start is not None)
+        if not closing and resource_id not in opened:
+            continue
+
+        if prev is not None and prev.at == at:
+            point = prev
+        elif prev is not None:
+            point = CostBreakpoint(
+                resource_id=resource_id, at=at,
+                cost=prev.cost + utils.cost_add(prev.rate, prev.at, at),
+                rate=prev.rate,
+                fixed_begun=prev.fixed_begun, fixed_ended=prev.fixed_ended,
+                max_start=prev.max_start,
+                min_active_start=prev.min_active_start,
+                max_stop=prev.max_stop)
+            db.session.add(point)
+        else:
+            point = CostBreakpoint(
+                resource_id=resource_id, at=at, cost=0.0, rate=0.0,
+                fixed_begun=0.0, fixed_ended=0.0)
+            db.session.add(point)
+
+        if closing:
+            # earlier breakpoints remember when their segments ended
+            (CostBreakpoint.query.
+             filter(CostBreakpoint.resource_id == resource_id).
+             filter(CostBreakpoint.at >= prev.min_active_start).
+             filter(CostBreakpoint.at < at).
+             filter(or_(CostBreakpoint.max_stop == None,
+                        CostBreakpoint.max_stop < at)).
+             update({CostBreakpoint.max_stop: at},
+                    synchronize_session=False))
+            point.rate = 0.0
+            point.fixed_ended = point.fixed_begun
+            point.min_active_start = None
+            if point.max_stop is None or point.max_stop < at:
+                point.max_stop = at
+        for segment in opened.get(resource_id, ()):
+            if segment.cost < 0:
+                point.fixed_begun += segment.cost
+            else:
+                point.rate += segment.cost
+            point.max_start = at
+            if point.min_active_start is None:
+                point.min_active_start = at
+
+
+def breakpoint_cost(point, at):
+    """
+    Cost of the resource up to ``at`` not earlier than ``point.at``.
+    """
+    return point.cost + utils.cost_add(point.rate, point.at, at)
+
+
+def bill_on_interval_integral(period_start, period_stop, filter, now):
+    """
+    Compute the bill from cost breakpoints. The linear cost of
+    a resource is the difference of its cumulative cost at the period
+    edges, so each resource takes two breakpoints whatever
+    the number of its segments.
+    """
+    start = aliased(CostBreakpoint)
+    stop = aliased(CostBreakpoint)
+    point = aliased(CostBreakpoint)
+
+    def point_at(aggregate, condition):
+        return (db.session.query(aggregate(point.at)).
+                filter(point.resource_id == Resource.id).
+                filter(condition).
+                correlate(Resource).as_scalar())
+
+    rows = apply_resource_filter(db.session.query(
+        Resource, start, stop,
+        point_at(func.min, point.at > period_start).label("next_at")).
+        join((stop, and_(
+            stop.resource_id == Resource.id,
+            stop.at == point_at(func.max, point.at < period_stop)))).
+        outerjoin((start, and_(
+            start.resource_id == Resource.id,
+            start.at == point_at(func.max, point.at <= period_start)))).
+        filter(or_(start.min_active_start != None,
+                   stop.max_start > period_start)).
+        order_by(Resource.account_id, Resource.id), filter).all()
+
+    inverted_costs = {}
+    for segments in segment_sources(period_start, period_stop):
+        for rsrc_id, cost in (db.session.query(
+                segments.c.resource_id,
+                func.sum(segment_cost_expr(period_start, period_stop, now,
+                                           segments))).
+                filter(segments.c.begin_at < period_stop).
+                filter(segments.c.end_at > period_start).
+                filter(segment_inverted(segments)).
+                group_by(segments.c.resource_id)):
+            inverted_costs[rsrc_id] = inverted_costs.get(rsrc_id, 0.0) + cost
+
+    def descr(rsrc, start, stop, next_at):
+        cost = breakpoint_cost(stop, min(now, period_stop)) + stop.fixed_begun
+        cost += inverted_costs.get(rsrc.id, 0.0)
+        min_start = next_at
+        if start is not None:
+            cost -= breakpoint_cost(start, period_start) + start.fixed_ended
+            if start.min_active_start is not None:
+                min_start = start.min_active_start
+        max_stop = stop.max_stop
+        if max_stop is not None and max_stop <= period_start:
+            max_stop = None
+        return resource_descr(rsrc, cost, min_start, stop.max_start, max_stop)
+
+    return ((account_id, [descr(*row) for row in account_rows])
+            for account_id, account_rows in groupby(
+                rows, lambda row: row[0].account_id))
+
+
+def segments_archive(before, limit=1000):
+    """
+    Move up to ``limit`` segments that ended before ``before``
+    to monthly archive tables by the month of end_at.
+    Linear segments are moved only when they are rolled up
+    (see :func:`rollup_segments`), because the ``rollup`` engine
+    takes days of archived linear segments from the rollup.
+    Inverted segments are never rolled up and are moved as they are.
+
+    :returns: the number of archived segments.
+    """
+    rows = (db.session.query(Segment.id, Segment.resource_id, Segment.cost,
+                             Segment.begin_at, Segment.end_at).
+        outerjoin(RolledSegment, RolledSegment.segment_id == Segment.id).
+        filter(Segment.end_at < before).
+        filter(or_(Segment.cost < 0, RolledSegment.segment_id != None,
+                   segment_inverted())).
+        order_by(Segment.id).
+        limit(limit).all())
+    if not rows:
+        return 0
+
+    months = {}
+    for row in rows:
+        months.setdefault(date(row.end_at.year, row.end_at.month, 1),
+                          []).append(row)
+    connection = db.session.connection()
+    for month, month_rows in sorted(months.iteritems()):
+        table = segment_archive_table(month)
+        table.create(bind=connection, checkfirst=True)
+        connection.execute(table.insert(), [
+            {"id": row.id, "resource_id": row.resource_id, "cost": row.cost,
+             "begin_at": row.begin_at, "end_at": row.end_at}
+            for row in month_rows])
+        min_begin_at = min(row.begin_at for row in month_rows)
+        max_end_at = max(row.end_at for row in month_rows)
+        archive = SegmentArchive.query.get(month)
+        if archive is None:
+            db.session.add(SegmentArchive(
+                month=month, min_begin_at=min_begin_at,
+                max_end_at=max_end_at, count=len(month_rows)))
+        else:
+            archive.min_begin_at = min(archive.min_begin_at, min_begin_at)
+            archive.max_end_at = max(archive.max_end_at, max_end_at)
+            archive.count += len(month_rows)
+
+    ids = [row.id for row in rows]
+    (RolledSegment.query.filter(RolledSegment.segment_id.in_(ids)).
+     delete(synchronize_session=False))
+    Segment.query.filter(Segment.id.in_(ids)).delete(
+        synchronize_session=False)
+    db.session.commit()
+    return len(rows)
+
+
+def segments_compact(after_id=0, limit=1000):
+    """
+    Merge chains of adjacent closed segments of a resource with equal
+    linear cost. Up to ``limit`` adjacent pairs are checked starting
+    after the first segment id ``after_id``.
+
+    Fixed cost segments are not merged since their cost is charged
+    for every segment. Boundaries must be whole seconds, so that
+    the merged segment costs exactly as much on any period
+    given in whole seconds (see :func:`utils.cost_add`).
+    Rolled up segments are merged only with rolled up ones.
+
+    :returns: the number of removed segments and the id to pass
+        as ``after_id`` for the next portion or None if
+        all segments are checked.
+    """
+    first = aliased(Segment)
+    second = aliased(Segment)
+    first_rolled = aliased(RolledSegment)
+    second_rolled = aliased(RolledSegment)
+    pairs = (db.session.query(
+        first.id, first.resource_id, first.begin_at, first.end_at,
+        second.id, second.end_at).
+        join((second, and_(second.resource_id == first.resource_id,
+                           second.begin_at == first.end_at,
+                           second.cost == first.cost))).
+        outerjoin((first_rolled, first_rolled.segment_id == first.id)).
+        outerjoin((second_rolled, second_rolled.segment_id == second.id)).
+        filter(first.id > after_id).
+        filter(first.cost >= 0).
+        filter(first.begin_at < first.end_at).
+        filter(second.end_at > second.begin_at).
+        filter(or_(and_(first_rolled.segment_id == None,
+                        second_rolled.segment_id == None),
+                   and_(first_rolled.segment_id != None,
+                        second_rolled.segment_id != None))).
+        order_by(first.id).
+        limit(limit).all())
+    if not pairs:
+        return 0, None
+
+    # a segment is merged with at most one neighbour on each side
+    links = {}
+    seconds = set()
+    resource_ids = set()
+    for first_id, resource_id, begin_at, boundary, second_id, end_at in pairs:
+        if (begin_at.microsecond or boundary.microsecond or
+                first_id in links or second_id in seconds):
+            continue
+        links[first_id] = (second_id, end_at)
+        seconds.add(second_id)
+        resource_ids.add(resource_id)
+
+    removed_ids = []
+    for head_id in links:
+        if head_id in seconds:
+            continue
+        segment_id = head_id
+        while segment_id in links:
+            segment_id, end_at = links[segment_id]
+            removed_ids.append(segment_id)
+        db.session.execute(Segment.__table__.update().
+            values(end_at=end_at).where(Segment.id == head_id))
+
+    if removed_ids:
+        (RolledSegment.query.
+         filter(RolledSegment.segment_id.in_(removed_ids)).
+         delete(synchronize_session=False))
+        Segment.query.filter(Segment.id.in_(removed_ids)).delete(
+            synchronize_session=False)
+        if breakpoints_enabled():
+            for resource_id in resource_ids:
+                breakpoints_rebuild(resource_id)
+    db.session.commit()
+    return (len(removed_ids),
+            pairs[-1][0] if len(pairs) == limit else None)
+
+
+report_engines = {
+    "integral": bill_on_interval_integral,
+    "numpy": bill_on_interval_numpy,
+    "python": bill_on_interval_python,
+    "rollup": bill_on_interval_rollup,
+    "sql": bill_on_interval_sql,
+}
+
+
+def bill_on_interval_iter(period_start, period_stop, filter={}):
+    """
+    Retrieve statistics like :func:`bill_on_interval` does.
+
+    The statistics are computed by the engine chosen with
+    the ``report_engine`` configuration parameter.
+
+    :returns: an iterable of (account id, billing list) pairs
+        ordered by account id.
+    """
+    now = datetime.utcnow().replace(microsecond=0)
+    if now <= period_start:
+        return ()
+
+    engine = report_engines.get(global_conf.report_engine,
+                                bill_on_interval_sql)
+    return engine(period_start, period_stop, filter, now)
 
 
 def bill_on_interval(period_start, period_stop, filter={}):
@@ -78,73 +972,32 @@ def bill_on_interval(period_start, period_stop, filter={}):
 
     :returns: a dictionary where keys are account ids and values are billing lists.
     """
-    now = datetime.utcnow()
-    if now <= period_start:
-        return {}
-
-    def apply_filter(res):
-        for attr in "account_id", "cost_center_id":
-            if attr in filter:
-                res = res.filter(getattr(Resource, attr) == filter[attr])
-        return res
-
-    result = apply_filter(db.session.query(Segment, Resource).
-                join(Resource).
-                filter(Segment.begin_at < period_stop).
-                filter(or_(Segment.end_at > period_start,
-                           Segment.end_at == None)))
+    return dict(bill_on_interval_iter(period_start, period_stop, filter))
 
-    retval = {}
-    rsrc_by_id = {}
-    for segment, rsrc in result:
-        if not retval.has_key(rsrc.account_id):
-            retval[rsrc.account_id] = []
-        try:
-            rsrc_descr = rsrc_by_id[rsrc.id]
-        except KeyError:
-            rsrc_descr = {
-                "id": rsrc.id,
-                "created_at": None,
-                "destroyed_at": None,
-                "cost": 0.0,
-                "parent_id": rsrc.parent_id,
-                "name": rsrc.name,
-                "rtype": rsrc.rtype,
-            }
-            retval[rsrc.account_id].append(rsrc_descr)
-            rsrc_by_id[rsrc.id] = rsrc_descr
-        begin_at = max(segment.begin_at, period_start)
-        end_at = min(segment.end_at or now, period_stop)
-        rsrc_descr["cost"] += utils.cost_add(segment.cost, begin_at, end_at)
-
-    result = apply_filter(db.session.query(Segment,
-        func.min(Segment.begin_at).label("min_start"),
-        func.max(Segment.begin_at).label("max_start"),
-        func.max(Segment.end_at).label("max_stop"),
-        Resource.id).
-        join(Resource).
-        group_by(Resource.id).
-        filter(Segment.begin_at < period_stop).
-        filter(or_(Segment.end_at > period_start,
-                   Segment.end_at == None)))
-
-    for row in result:
-        rsrc_descr = rsrc_by_id.get(row.id, None)
-        if not rsrc_descr:
-            continue
-        rsrc_descr["created_at"] = row.min_start
-        if row.max_stop is None or row.max_start < row.max_stop:
-            rsrc_descr["destroyed_at"] = row.max_stop
 
-    return retval
+def insert_or_select(cls, name, **kwargs):
+    """
+    Insert an object with the given ``name`` in a savepoint.
+    If a concurrent transaction has already inserted it,
+    select the existing object instead.
+    The caller is responsible for commit.
+    """
+    savepoint = db.session.begin_nested()
+    try:
+        obj = cls(name=name, **kwargs)
+        db.session.add(obj)
+        db.session.flush()
+        savepoint.commit()
+    except IntegrityError:
+        savepoint.rollback()
+        obj = cls.query.filter_by(name=name).one()
+    return obj
 
 
 def cost_center_get_or_create(name):
     obj = CostCenter.query.filter_by(name=name).first()
     if obj == None:
-        obj = CostCenter(name=name)
-        db.session.add(obj)
-        db.session.commit()
+        obj = insert_or_select(CostCenter, name)
     return obj
 
 
@@ -156,13 +1009,16 @@ def account_get_or_create(name, cost_center_name=None):
                 cost_center_name).id
         else:
             cost_center_id = None
-        obj = Account(name=name, cost_center_id=cost_center_id)
-        db.session.add(obj)
-        db.session.commit()
+        obj = insert_or_select(Account, name,
+                               cost_center_id=cost_center_id)
     return obj
 
 
 def resource_get_or_create(account_id, cost_center_id, parent_id, rtype, name):
+    """
+    Find or create a resource. A new resource is only flushed
+    to get its id, the caller is responsible for commit.
+    """
     obj = Resource.query.filter_by(
         account_id=account_id,
         parent_id=parent_id,
@@ -176,14 +1032,175 @@ def resource_get_or_create(account_id, cost_center_id, parent_id, rtype, name):
             rtype=rtype,
             name=name)
         db.session.add(obj)
-        db.session.commit()
+        db.session.flush()
     return obj
 
 
+resource_cache = utils.LRUCache(global_conf.resource_cache_size)
+"""
+Resource ids by (account_id, parent_id, rtype, name).
+"""
+
+account_cache = utils.LRUCache(global_conf.account_cache_size)
+"""
+(account_id, cost_center_id) by account name.
+"""
+
+_local = threading.local()
+
+
+def pending_identities():
+    """
+    Identities resolved by the current unit of work. They are added to
+    the shared caches only when the unit of work is committed.
+    """
+    try:
+        return _local.pending
+    except AttributeError:
+        _local.pending = []
+        return _local.pending
+
+
+def pending_clear():
+    del pending_identities()[:]
+
+
+def use_read_replica(enabled=True):
+    """
+    Send queries of the current thread to heart_db_read_uri
+    (if it is set) until this is disabled.
+    """
+    routing.read_only = enabled
+
+
+@contextlib.contextmanager
+def primary():
+    """
+    Send queries of the current thread to heart_db_uri
+    even if the read replica is enabled.
+    """
+    read_only = getattr(routing, "read_only", False)
+    routing.read_only = False
+    try:
+        yield
+    finally:
+        routing.read_only = read_only
+
+
+def commit():
+    db.session.commit()
+    pending = pending_identities()
+    for cache, key, value in pending:
+        cache[key] = value
+    del pending[:]
+
+
+def rollback():
+    db.session.rollback()
+    pending_clear()
+
+
+def begin_nested():
+    db.session.begin_nested()
+    return len(pending_identities())
+
+
+def rollback_nested(savepoint):
+    db.session.rollback()
+    del pending_identities()[savepoint:]
+
+
+def account_ids_get_or_create(name, cost_center_name=None):
+    """
+    :returns: (account_id, cost_center_id) of account ``name``.
+    """
+    identity_version.check()
+    ids = account_cache.get(name)
+    if ids is None:
+        obj = account_get_or_create(name, cost_center_name)
+        ids = (obj.id, obj.cost_center_id)
+        pending_identities().append((account_cache, name, ids))
+    return ids
+
+
+def resource_id_get_or_create(account_id, cost_center_id, parent_id,
+                              rtype, name):
+    identity_version.check()
+    key = (account_id, parent_id, rtype, name)
+    rsrc_id = resource_cache.get(key)
+    if rsrc_id is None:
+        rsrc_id = resource_get_or_create(
+            account_id, cost_center_id, parent_id, rtype, name).id
+        pending_identities().append((resource_cache, key, rsrc_id))
+    return rsrc_id
+
+
 def resource_segment_end(resource_id, end_at):
+    resource_segments_end((resource_id, ), end_at)
+
+
+def resource_segments_end(resource_ids, end_at):
+    """
+    Close the open segments of all ``resource_ids``. They are found
+    in ``open_segment`` and updated in ``segment`` by primary key.
+    """
+    if not resource_ids:
+        return
+    # segments pending in the session must be closed as well
+    db.session.flush()
+    open_ids = select([OpenSegment.segment_id]).where(
+        OpenSegment.resource_id.in_(resource_ids))
     db.session.execute(Segment.__table__.update().
-        values(end_at=end_at).where(
-            Segment.resource_id == resource_id))
+        values(end_at=end_at).where(Segment.id.in_(open_ids)))
+    db.session.execute(OpenSegment.__table__.delete().where(
+        OpenSegment.resource_id.in_(resource_ids)))
+
+
+def segments_add(segments):
+    """
+    Add new open ``segments`` to the history and to ``open_segment``.
+    """
+    if not segments:
+        return
+    db.session.add_all(segments)
+    db.session.flush()
+    db.session.add_all([OpenSegment(segment_id=segment.id,
+                                    resource_id=segment.resource_id,
+                                    cost=segment.cost,
+                                    begin_at=segment.begin_at)
+                        for segment in segments])
+
+
+def open_segments_rebuild():
+    """
+    Fill ``open_segment`` from open segments of the history.
+    """
+    db.session.flush()
+    connection = db.session.connection()
+    connection.execute(OpenSegment.__table__.delete())
+    connection.execute(text(
+        "insert into %(open_segment)s"
+        " (segment_id, resource_id, cost, begin_at)"
+        " select id, resource_id, cost, begin_at"
+        " from %(segment)s where end_at is NULL" %
+        {"segment": Segment.__tablename__,
+         "open_segment": OpenSegment.__tablename__}))
+
+
+def open_segments_ensure():
+    """
+    Fill ``open_segment`` if it is empty while ``segment`` has open
+    segments, as happens when the table has just been created
+    in an existing database. Nothing must write segments meanwhile.
+
+    :returns: True if the table has been filled.
+    """
+    if (OpenSegment.query.first() is not None or
+            Segment.query.filter(Segment.end_at == None).first() is None):
+        return False
+    open_segments_rebuild()
+    db.session.commit()
+    return True
 
 
 def account_map():
@@ -191,9 +1208,113 @@ def account_map():
                  for obj in Account.query.all()))
 
 
+def counter_get(name):
+    # a lagging replica would hide the latest bump
+    with primary():
+        row = db.session.query(Counter.value).filter_by(name=name).first()
+    return row[0] if row else 0
+
+
+def counter_bump(name):
+    updated = (db.session.query(Counter).filter_by(name=name).
+               update({Counter.value: Counter.value + 1},
+                      synchronize_session=False))
+    if not updated:
+        db.session.add(Counter(name=name, value=1))
+
+
+class TariffCache(object):
+    """
+    Tariffs loaded once per process. Other processes are
+    noticed to change tariffs by the ``tariff`` counter
+    that is checked at most once in ``tariff_check_interval`` seconds.
+    """
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.tariffs = None
+        self.version = None
+        self.checked_at = None
+
+    def get(self):
+        now = time_mod.time()
+        if (self.tariffs is not None and
+                now - self.checked_at < global_conf.tariff_check_interval):
+            return self.tariffs
+        version = counter_get("tariff")
+        if self.tariffs is None or version != self.version:
+            with primary():
+                self.tariffs = dict(((obj.rtype, obj.multiplier)
+                                     for obj in Tariff.query.all()))
+            self.version = version
+        self.checked_at = now
+        return self.tariffs
+
+
+tariff_cache = TariffCache()
+
+
+class CacheVersion(object):
+    """
+    Version of shared caches kept in the ``name`` counter.
+    A process that changes cached data bumps the counter; other
+    processes notice it at most once in ``tariff_check_interval``
+    seconds and clear their caches.
+    """
+
+    def __init__(self, name, *caches):
+        self.name = name
+        self.caches = caches
+        self.invalidate()
+
+    def invalidate(self):
+        for cache in self.caches:
+            cache.clear()
+        self.version = None
+        self.checked_at = None
+
+    def check(self):
+        now = time_mod.time()
+        if (self.checked_at is not None and
+                now - self.checked_at < global_conf.tariff_check_interval):
+            return
+        version = counter_get(self.name)
+        if version != self.version:
+            for cache in self.caches:
+                cache.clear()
+            self.version = version
+        self.checked_at = now
+
+    def bump(self):
+        """
+        Bump the version in the current transaction. Call
+        :meth:`invalidate` after the transaction is committed.
+        """
+        counter_bump(self.name)
+
+
+identity_version = CacheVersion("identity", account_cache, resource_cache)
+"""
+Version of ``account_cache`` and ``resource_cache`` bumped
+on renames of accounts and resources and on cost center deletion.
+"""
+
+
 def tariff_map():
-    return dict(((obj.rtype, obj.multiplier)
-                 for obj in Tariff.query.all()))
+    return dict(tariff_cache.get())
+
+
+def tariffs_update(new_tariffs):
+    """
+    Save ``new_tariffs`` and notify all processes about the change.
+    """
+    for key, value in new_tariffs.iteritems():
+        if isinstance(value, int) or isinstance(value, float):
+            db.session.merge(Tariff(rtype=key, multiplier=value))
+    counter_bump("tariff")
+    tariff_cache.invalidate()
 
 
 def resource_find(rtype, name):
@@ -212,6 +1333,9 @@ def tariffs_migrate(old_tariffs, new_tariffs, event_datetime):
     if not new_tariffs:
         return
 
+    tables = {"segment": Segment.__tablename__,
+              "open_segment": OpenSegment.__tablename__,
+              "resource": Resource.__tablename__}
     connection = db.session.connection()
     for rtype in new_tariffs:
         old_t = old_tariffs.get(rtype, 1.0)
@@ -222,13 +1346,11 @@ def tariffs_migrate(old_tariffs, new_tariffs, event_datetime):
             text(
                 "insert into %(segment)s"
                 " (resource_id, cost, begin_at, end_at)"
-                " select resource_id, cost * :mpy, :event_datetime, NULL"
-                " from %(segment)s, %(resource)s"
-                " where end_at is NULL "
-                " and %(segment)s.resource_id = %(resource)s.id"
-                " and %(resource)s.rtype = :rtype" %
-                {"segment": Segment.__tablename__,
-                 "resource": Resource.__tablename__}),
+                " select %(open_segment)s.resource_id,"
+                " cost * :mpy, :event_datetime, NULL"
+                " from %(open_segment)s, %(resource)s"
+                " where %(open_segment)s.resource_id = %(resource)s.id"
+                " and %(resource)s.rtype = :rtype" % tables),
             mpy=new_tariffs[rtype] / old_t,
             event_datetime=event_datetime,
             rtype=rtype)
@@ -238,11 +1360,38 @@ def tariffs_migrate(old_tariffs, new_tariffs, event_datetime):
             text(
                 "update %(segment)s"
                 " set end_at = :event_datetime"
-                " where end_at is NULL"
-                " and begin_at != :event_datetime"
+                " where id in"
+                " (select segment_id from %(open_segment)s, %(resource)s"
+                " where %(open_segment)s.resource_id = %(resource)s.id"
+                " and %(resource)s.rtype = :rtype"
+                " and %(open_segment)s.begin_at != :event_datetime)" %
+                tables),
+            event_datetime=event_datetime,
+            rtype=rtype)
+        connection.execute(
+            text(
+                "delete from %(open_segment)s"
+                " where begin_at != :event_datetime"
                 " and resource_id in"
                 " (select id from %(resource)s where rtype=:rtype)" %
-                {"segment": Segment.__tablename__,
-                 "resource": Resource.__tablename__}),
+                tables),
+            event_datetime=event_datetime,
+            rtype=rtype)
+        connection.execute(
+            text(
+                "insert into %(open_segment)s"
+                " (segment_id, resource_id, cost, begin_at)"
+                " select id, resource_id, cost, begin_at from %(segment)s"
+                " where begin_at = :event_datetime and end_at is NULL"
+                " and resource_id in"
+                " (select id from %(resource)s where rtype=:rtype)"
+                " and id not in (select segment_id from %(open_segment)s)" %
+                tables),
             event_datetime=event_datetime,
             rtype=rtype)
+
+    if breakpoints_enabled():
+        for rsrc_id, in (db.session.query(Resource.id).
+                         filter(Resource.rtype.in_(new_tariffs.keys())).
+                         all()):
+            breakpoints_rebuild(rsrc_id)
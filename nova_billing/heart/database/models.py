@@ -26,6 +26,8 @@ SQLAlchemy models for Nova Billing.
 import json
 
 from flaskext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, MetaData
+from sqlalchemy.schema import DDL
 
 from . import db
 
@@ -42,13 +44,13 @@ class BillingBase(object):
 class CostCenter(db.Model, BillingBase):
     __tablename__ = "cost_center"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(255), index=True, nullable=False)
+    name = db.Column(db.String(255), index=True, unique=True, nullable=False)
 
 
 class Account(db.Model, BillingBase):
     __tablename__ = "account"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(255), index=True, nullable=False)
+    name = db.Column(db.String(255), index=True, unique=True, nullable=False)
     cost_center_id = db.Column(db.Integer,
                                db.ForeignKey("cost_center.id"),
                                index=True, nullable=True)
@@ -70,14 +72,18 @@ class Resource(db.Model, BillingBase):
                           db.ForeignKey("resource.id"))
     attrs = db.Column(db.UnicodeText)
 
-    def get_attrs(self):
-        if self.attrs:
+    @staticmethod
+    def parse_attrs(attrs):
+        if attrs:
             try:
-                return json.loads(self.attrs)
+                return json.loads(attrs)
             except:
                 return {}
         return {}
 
+    def get_attrs(self):
+        return self.parse_attrs(self.attrs)
+
     def set_attrs(self, attrs):
         self.attrs = json.dumps(attrs)
 
@@ -97,8 +103,150 @@ class Segment(db.Model, BillingBase):
     end_at = db.Column(db.DateTime, index=True, nullable=True)
 
 
+class OpenSegment(db.Model, BillingBase):
+    """
+    Open segments (``end_at`` is NULL) duplicated from ``segment``,
+    so that current usage is found without scanning the history.
+    """
+    __tablename__ = "open_segment"
+    segment_id = db.Column(db.Integer,
+                           db.ForeignKey("segment.id"),
+                           primary_key=True, autoincrement=False)
+    resource_id = db.Column(db.Integer,
+                            db.ForeignKey("resource.id"),
+                            index=True, nullable=False)
+    cost = db.Column(db.Float, nullable=False)
+    begin_at = db.Column(db.DateTime, nullable=False)
+
+
+# get-or-create lookup of resources
+db.Index("ix_resource_lookup", Resource.account_id, Resource.parent_id,
+         Resource.rtype, Resource.name)
+# open segments of a resource
+db.Index("ix_segment_resource_end", Segment.resource_id, Segment.end_at)
+# segments overlapping the report period
+db.Index("ix_segment_period", Segment.begin_at, Segment.end_at)
+
+
+partial_indexes = {
+    "ix_segment_open": "CREATE INDEX %(concurrently)s ix_segment_open"
+                       " ON segment (resource_id) WHERE end_at IS NULL",
+    "ix_segment_inverted": "CREATE INDEX %(concurrently)s ix_segment_inverted"
+                           " ON segment (begin_at) WHERE end_at < begin_at",
+}
+"""
+Indexes on a part of rows. They are created only for
+backends supporting them (see :data:`partial_index_dialects`).
+"""
+
+partial_index_dialects = ("postgresql", "sqlite")
+
+
+for name, ddl in partial_indexes.iteritems():
+    event.listen(Segment.__table__, "after_create",
+                 DDL(ddl % {"concurrently": ""}).execute_if(
+                     dialect=partial_index_dialects))
+
+
+class SegmentArchive(db.Model, BillingBase):
+    """
+    Catalog of monthly archives of closed segments
+    (see :func:`segment_archive_table`).
+    """
+    __tablename__ = "segment_archive"
+    # the first day of the month of end_at
+    month = db.Column(db.Date, primary_key=True)
+    min_begin_at = db.Column(db.DateTime, nullable=False)
+    max_end_at = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
+archive_metadata = MetaData()
+"""
+Archive tables are created by the archive command,
+not by ``db.create_all()``.
+"""
+
+
+def segment_archive_table(month):
+    """
+    Table of closed segments with end_at in ``month``.
+    """
+    name = "segment_%s" % month.strftime("%Y%m")
+    try:
+        return archive_metadata.tables[name]
+    except KeyError:
+        return db.Table(
+            name, archive_metadata,
+            db.Column("id", db.Integer, primary_key=True, autoincrement=False),
+            db.Column("resource_id", db.Integer, index=True, nullable=False),
+            db.Column("cost", db.Float, nullable=False),
+            db.Column("begin_at", db.DateTime, nullable=False),
+            db.Column("end_at", db.DateTime, index=True, nullable=False))
+
+
 class Tariff(db.Model, BillingBase):
     __tablename__ = "tariff"
     rtype = db.Column(db.String(TypeLength),
                       index=True, nullable=False, primary_key=True)
     multiplier = db.Column(db.Float, nullable=False)
+
+
+class CostRollup(db.Model, BillingBase):
+    """
+    Linear cost of closed segments of a resource on a day
+    and the bounds of these segments.
+    """
+    __tablename__ = "cost_rollup"
+    resource_id = db.Column(db.Integer,
+                            db.ForeignKey("resource.id"),
+                            primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True, index=True)
+    cost = db.Column(db.Float, nullable=False)
+    min_start = db.Column(db.DateTime, nullable=False)
+    max_start = db.Column(db.DateTime, nullable=False)
+    max_stop = db.Column(db.DateTime, nullable=False)
+
+
+class RolledSegment(db.Model, BillingBase):
+    """
+    Segments that are already added to :class:`CostRollup`.
+    """
+    __tablename__ = "rolled_segment"
+    segment_id = db.Column(db.Integer,
+                           db.ForeignKey("segment.id"),
+                           primary_key=True, autoincrement=False)
+
+
+class CostBreakpoint(db.Model, BillingBase):
+    """
+    State of a resource at a segment boundary ``at``.
+    Linear cost of any interval is interpolated between breakpoints.
+    """
+    __tablename__ = "cost_breakpoint"
+    resource_id = db.Column(db.Integer,
+                            db.ForeignKey("resource.id"),
+                            primary_key=True, autoincrement=False)
+    at = db.Column(db.DateTime, primary_key=True)
+    # linear cost up to ``at``
+    cost = db.Column(db.Float, nullable=False)
+    # sum of linear costs of segments open after ``at``
+    rate = db.Column(db.Float, nullable=False)
+    # fixed costs of segments begun (ended) at or before ``at``
+    fixed_begun = db.Column(db.Float, nullable=False)
+    fixed_ended = db.Column(db.Float, nullable=False)
+    # the latest begin_at at or before ``at``
+    max_start = db.Column(db.DateTime, nullable=True)
+    # the earliest begin_at of segments open after ``at``
+    min_active_start = db.Column(db.DateTime, nullable=True)
+    # the latest end_at of segments begun at or before ``at``
+    max_stop = db.Column(db.DateTime, nullable=True)
+
+
+class Counter(db.Model, BillingBase):
+    """
+    Named counters shared by Heart processes.
+    """
+    __tablename__ = "counter"
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
@@ -21,24 +21,215 @@
 
 """Starter script for Nova Billing heart."""
 
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import sys
+import time
+import errno
+import signal
 import argparse
 import logging
 
-from nova_billing.heart import app
+import eventlet.hubs
+import eventlet.wsgi
+import greenlet
+
+from nova_billing.heart import app, rest
 from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
 from nova_billing.utils import global_conf
+from nova_billing import utils
 
 
 LOG = logging.getLogger(__name__)
 
 
+class WsgiLog(object):
+    """
+    File-like object passing access log of eventlet.wsgi to logging.
+    """
+    def write(self, message):
+        LOG.info(message.rstrip())
+
+
+def serve(sock, worker=False):
+    """
+    Serve requests on ``sock`` until SIGTERM, then wait for
+    in-flight requests for up to ``heart_graceful_timeout`` seconds.
+
+    SIGINT is handled like SIGTERM unless this is a ``worker``
+    of :class:`Master`, which stops its workers itself.
+    """
+    stopping = []
+    stop = lambda signum, frame: stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN if worker else stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    server = eventlet.spawn(
+        eventlet.wsgi.server, sock, app,
+        log=WsgiLog(),
+        max_size=global_conf.heart_worker_connections,
+        keepalive=global_conf.heart_keepalive)
+    while not stopping and not server.dead:
+        eventlet.sleep(0.5)
+    # wsgi.server waits for its connections when it is killed
+    server.kill()
+    with eventlet.Timeout(global_conf.heart_graceful_timeout, False):
+        try:
+            server.wait()
+        except greenlet.GreenletExit:
+            pass
+
+
+class Master(object):
+    """
+    Pre-forked workers sharing one listening socket.
+
+    SIGHUP reloads settings and replaces workers gracefully,
+    SIGTERM and SIGINT stop them gracefully. Workers that exit
+    unexpectedly are restarted with an exponential backoff, and
+    the master gives up after ``respawn_limit`` failures in a row.
+    """
+    respawn_delay = 0.5
+    respawn_delay_max = 60
+    # workers living longer than that reset the failure count
+    respawn_stable_time = 60
+    respawn_limit = 10
+
+    def __init__(self, sock, workers):
+        self.sock = sock
+        self.workers = workers
+        # pid -> time when the worker was spawned
+        self.children = {}
+        self.retiring = {}
+        self.signals = []
+        self.failures = 0
+        self.respawn_at = 0
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # do not share the parent's event loop
+            eventlet.hubs.use_hub()
+            try:
+                serve(self.sock, worker=True)
+            except:
+                LOG.exception("worker failed")
+            finally:
+                os._exit(0)
+        self.children[pid] = time.time()
+
+    def retire(self, pids):
+        deadline = time.time() + global_conf.heart_graceful_timeout
+        for pid in pids:
+            self.kill(pid, signal.SIGTERM)
+            self.retiring[pid] = deadline
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid in self.children:
+                LOG.error("worker %s exited with status %s" % (pid, status))
+                self.failed(time.time() - self.children.pop(pid))
+            self.retiring.pop(pid, None)
+
+    def failed(self, lifetime):
+        if lifetime > self.respawn_stable_time:
+            self.failures = 0
+        self.failures += 1
+        delay = min(self.respawn_delay * 2 ** (self.failures - 1),
+                    self.respawn_delay_max)
+        self.respawn_at = time.time() + delay
+
+    def reload(self):
+        """
+        Reload settings for new workers. Database and logging
+        settings are applied only on restart.
+        """
+        global_conf.load_from_file(utils.CONFIG_FILE)
+        self.workers = max(global_conf.heart_workers, 1)
+        # workers inherit the caches of the master
+        db_api.resource_cache.size = global_conf.resource_cache_size
+        db_api.account_cache.size = global_conf.account_cache_size
+        report_cache = rest.report_cache
+        report_cache.reports.size = global_conf.report_cache_size
+        report_cache.item_size = global_conf.report_cache_item_size
+        report_cache.ttl = global_conf.report_cache_ttl
+        for cache in (db_api.resource_cache, db_api.account_cache,
+                      report_cache):
+            cache.clear()
+
+    def run(self):
+        """
+        Manage workers until they are stopped. Return ``False``
+        if the master gave up on failing workers.
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum,
+                          lambda signum, frame: self.signals.append(signum))
+        stopping = False
+        gave_up = False
+        while not stopping or self.retiring:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    LOG.info("restarting workers")
+                    self.reload()
+                    old_children, self.children = self.children, {}
+                    self.retire(old_children)
+                    self.failures = 0
+                    self.respawn_at = 0
+                elif not stopping:
+                    LOG.info("stopping workers")
+                    stopping = True
+                    self.retire(self.children)
+                    self.children = {}
+            self.reap()
+            if not stopping and self.failures >= self.respawn_limit:
+                LOG.error("workers failed %d times in a row, stopping"
+                          % self.failures)
+                stopping = True
+                gave_up = True
+                self.retire(self.children)
+                self.children = {}
+            if not stopping and time.time() >= self.respawn_at:
+                while len(self.children) < self.workers:
+                    self.spawn()
+            now = time.time()
+            for pid, deadline in self.retiring.items():
+                if deadline < now:
+                    self.kill(pid, signal.SIGKILL)
+            time.sleep(0.5)
+        return not gave_up
+
+
 def main():
     global_conf.logging()
 
     arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--debug", "-d", default=False,
+                            action="store_true",
+                            help="run Flask development server")
     arg_parser.add_argument("--reload", "-r", default=False,
                             action="store_true",
-                            help="reload when the source changes")
+                            help="reload when the source changes "
+                            "(implies --debug)")
     arg_parser.add_argument("host:port", nargs="?",
                             default="%s:%s" % (
                                 global_conf.host,
@@ -48,9 +239,24 @@ def main():
 
     LOG.info("starting heart")
     db.create_all()
+    # before workers are forked and requests are served
+    with app.test_request_context():
+        if db_api.open_segments_ensure():
+            LOG.info("filled open segments")
     listen = getattr(args, "host:port").split(':')
-    app.debug = True
-    app.run(host=listen[0], port=int(listen[1]), use_reloader=args.reload)
+    if args.debug or args.reload:
+        app.debug = True
+        app.run(host=listen[0], port=int(listen[1]), use_reloader=args.reload)
+        return
+
+    # connections must not be shared with forked workers
+    db.engine.dispose()
+    sock = eventlet.listen((listen[0], int(listen[1])))
+    if global_conf.heart_workers > 1:
+        if not Master(sock, global_conf.heart_workers).run():
+            sys.exit(1)
+    else:
+        serve(sock)
 
 
 if __name__ == '__main__':
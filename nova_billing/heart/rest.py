@@ -24,17 +24,21 @@ REST API for Nova Billing Heart
 """
 
 import datetime
+import functools
 import json
 import logging
+import types
 
 from flask import Flask, request, session, redirect, url_for, \
      jsonify, Response
 from werkzeug.exceptions import BadRequest, Unauthorized, NotFound
+from werkzeug.urls import url_encode
 from . import app
 
+from .cache import ReportCache
 from .database import api as db_api
 from .database import db
-from .database.models import BillingBase, CostCenter, Account, Resource, Segment, Tariff
+from .database.models import BillingBase, CostCenter, Account, Resource, Segment
 
 from nova_billing import utils
 from nova_billing.version import version_string
@@ -43,6 +47,11 @@ from nova_billing.version import version_string
 LOG = logging.getLogger(__name__)
 
 
+report_cache = ReportCache(utils.global_conf.report_cache_size,
+                           utils.global_conf.report_cache_item_size,
+                           utils.global_conf.report_cache_ttl)
+
+
 def request_json():
     ret = request.json
     if ret == None:
@@ -57,6 +66,53 @@ def to_json(resp):
             mimetype=utils.ContentType.JSON)
 
 
+def iter_json(obj):
+    """
+    Encode ``obj`` to JSON by chunks. Generators are encoded
+    as arrays item by item, so they are never loaded entirely.
+    Output is the same as of ``json.dumps``.
+    """
+    if isinstance(obj, types.GeneratorType):
+        yield "["
+        for index, value in enumerate(obj):
+            if index:
+                yield ", "
+            for chunk in iter_json(value):
+                yield chunk
+        yield "]"
+    elif (isinstance(obj, dict) and
+          any(isinstance(value, types.GeneratorType)
+              for value in obj.itervalues())):
+        yield "{"
+        for index, (key, value) in enumerate(obj.iteritems()):
+            yield "%s%s: " % (", " if index else "", json.dumps(key))
+            for chunk in iter_json(value):
+                yield chunk
+        yield "}"
+    else:
+        yield json.dumps(obj, default=utils.datetime_to_str)
+
+
+def join_chunks(chunks, size=65536):
+    buf = []
+    buf_size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= size:
+            yield "".join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield "".join(buf)
+
+
+def to_json_stream(chunks):
+    return Response(
+            join_chunks(chunks),
+            mimetype=utils.ContentType.JSON)
+
+
 def check_attrs(rj, attr_list):
     for attr in attr_list:
         if attr not in rj:
@@ -72,6 +128,33 @@ def check_and_get_datatime(rj):
     return ret
 
 
+def get_int_arg(name, min_value):
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+    if value is None or value < min_value:
+        raise BadRequest(
+            description="%s must be an integer not less than %s" %
+            (name, min_value))
+    return value
+
+
+def set_next_link(response, obj_list, limit):
+    """
+    Add a link to the next page if the page is full.
+    """
+    if limit is not None and obj_list and len(obj_list) >= limit:
+        args = request.args.copy()
+        args["marker"] = obj_list[-1].id
+        response.headers["Link"] = '<%s?%s>; rel="next"' % (
+            request.base_url, url_encode(args))
+    return response
+
+
 def get_request_version():
     return request.environ.get("PATH_INFO", "")[1:3]
 
@@ -86,10 +169,8 @@ def account_get_or_create(rj):
         account_id = resource.account_id
         cost_center_id = resource.cost_center_id
     else:
-        account = db_api.account_get_or_create(
+        account_id, cost_center_id = db_api.account_ids_get_or_create(
             account_name, rj.get("cost_center_name", None))
-        account_id = account.id
-        cost_center_id = account.cost_center_id
 
     return account_id, cost_center_id
 
@@ -169,6 +250,26 @@ class BillingBaseExt(object):
             res = res.filter_by(**filter)
         return res
 
+    @classmethod
+    def query_paginated(cls):
+        """
+        Apply optional keyset pagination to :meth:`query_filtered`.
+        At most ``limit`` objects with id greater than ``marker``
+        are returned in id order; ``limit`` is capped by
+        ``page_limit_max``.
+
+        :returns: the query and the page limit or ``None``.
+        """
+        res = cls.query_filtered()
+        marker = get_int_arg("marker", 0)
+        limit = get_int_arg("limit", 1)
+        if marker is not None:
+            res = res.filter(cls.id > marker)
+        if limit is not None:
+            limit = min(limit, utils.global_conf.page_limit_max)
+            res = res.order_by(cls.id).limit(limit)
+        return res, limit
+
     def to_json(self):
         fld_list = self.fld_list()
         return to_json(
@@ -234,6 +335,27 @@ CostCenter._fld_list = [(), ("id", "name")]
 Resource._fld_list = [("id", "name", "rtype", "parent_id", "account_id"), ("cost_center_id", )]
 
 
+@app.teardown_request
+def unit_of_work_end(exception=None):
+    db_api.pending_clear()
+
+
+@app.before_request
+def read_replica_reset():
+    db_api.use_read_replica(False)
+
+
+def read_only(view):
+    """
+    Let queries of ``view`` go to the read replica.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        db_api.use_read_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
 @app.route("/version")
 def version_get():
     def links(base_url, url_list):
@@ -261,6 +383,7 @@ def version_get():
 
 @app.route("/v1/bill")
 @app.route("/v2/report")
+@read_only
 def report_get():
     period_start, period_end = get_period()
     resource_filter = Account.filter_by_id_name()
@@ -270,7 +393,14 @@ def report_get():
             resource_filter = CostCenter.filter_by_id_name()
     else:
         accounts_key = "bill"
-    total_statistics = db_api.bill_on_interval(
+    cache_key = report_cache.key(
+        get_request_version(), period_start, period_end, resource_filter)
+    body = report_cache.get(cache_key)
+    if body is not None:
+        return Response(body, mimetype=utils.ContentType.JSON)
+
+    snapshot = report_cache.snapshot()
+    total_statistics = db_api.bill_on_interval_iter(
         period_start, period_end, resource_filter)
 
     accounts = db_api.account_map()
@@ -278,34 +408,39 @@ def report_get():
     ans_dict = {
         "period_start": period_start,
         "period_end": period_end,
-        accounts_key: [{
+        accounts_key: ({
             "id": key, "name": accounts.get(key, None),
             "resources": value
-        } for key, value in total_statistics.iteritems()],
+        } for key, value in total_statistics),
     }
-    return to_json(ans_dict)
+    return to_json_stream(report_cache.collect(
+        cache_key, snapshot, iter_json(ans_dict)))
 
 
 def process_event(rsrc, parent_id,
                   account_id, cost_center_id,
-                  event_datetime, tariffs):
+                  event_datetime, tariffs,
+                  closed_ids, segments):
     """
     linear - saved as a non-negative cost
     fixed - saved with opposite sign (as a non-positive cost)
     fixed=None - closes the segment but does not create a new one
+
+    Ids of resources to close are appended to ``closed_ids``
+    and new segments to ``segments``.
     """
     if not "rtype" in rsrc:
         return
-    rsrc_obj = db_api.resource_get_or_create(
+    rsrc_id = db_api.resource_id_get_or_create(
         account_id, cost_center_id, parent_id,
         rsrc["rtype"], rsrc.get("name", None))
-    rsrc_id = rsrc_obj.id
 
     try:
         attrs = rsrc["attrs"]
     except KeyError:
         pass
     else:
+        rsrc_obj = Resource.query.get(rsrc_id)
         if rsrc_obj.attrs:
             attrs.update(rsrc_obj.get_attrs())
         rsrc_obj.set_attrs(attrs)
@@ -320,33 +455,33 @@ def process_event(rsrc, parent_id,
         cost = None
         close_segment = False
     if close_segment:
-        db_api.resource_segment_end(rsrc_id, event_datetime)
+        closed_ids.append(rsrc_id)
     if cost is not None:
-        obj = Segment(
+        segments.append(Segment(
             resource_id=rsrc_id,
             cost=-cost * tariffs.get(rsrc["rtype"], 1),
-            begin_at=event_datetime)
-        db.session.add(obj)
+            begin_at=event_datetime))
 
     for child in rsrc.get("children", ()):
         process_event(child, rsrc_id,
                       account_id, cost_center_id,
-                      event_datetime, tariffs)
+                      event_datetime, tariffs,
+                      closed_ids, segments)
 
 
 def process_resource(rsrc, parent_id, account_id, cost_center_id):
     if not "rtype" in rsrc:
         return
-    rsrc_obj = db_api.resource_get_or_create(
+    rsrc_id = db_api.resource_id_get_or_create(
         account_id, cost_center_id, parent_id,
         rsrc["rtype"], rsrc.get("name", None))
-    rsrc_id = rsrc_obj.id
 
     try:
         attrs = rsrc["attrs"]
     except KeyError:
         pass
     else:
+        rsrc_obj = Resource.query.get(rsrc_id)
         rsrc_obj.set_attrs(attrs)
         db.session.merge(rsrc_obj)
 
@@ -354,26 +489,140 @@ def process_resource(rsrc, parent_id, account_id, cost_center_id):
         process_resource(child, rsrc_id, account_id, cost_center_id)
 
 
+def event_apply(rj, tariffs):
+    """
+    Process one root event ``rj`` within the current transaction.
+
+    :returns: a dictionary describing the processed event.
+    """
+    if not isinstance(rj, dict):
+        raise BadRequest(description="event must be an object")
+    rj_datetime = check_and_get_datatime(rj)
+    account_id, cost_center_id = account_get_or_create(rj)
+
+    closed_ids = []
+    segments = []
+    process_event(rj, None,  account_id, cost_center_id, rj_datetime, tariffs,
+                  closed_ids, segments)
+    db_api.resource_segments_end(closed_ids, rj_datetime)
+    db_api.segments_add(segments)
+    db_api.breakpoints_update(closed_ids, segments, rj_datetime)
+    report_cache.touch(rj_datetime)
+    return {"account_id": account_id,
+            "rtype": rj["rtype"],
+            "datetime": rj_datetime,
+            "name": rj.get("name", None)}
+
+
 @app.route("/v1/event", methods=["POST"])
 @app.route("/v2/event", methods=["POST"])
 def event_create():
     rj = request_json()
     LOG.debug("received event %s" % rj)
-    rj_datetime = check_and_get_datatime(rj)
-    account_id, cost_center_id = account_get_or_create(rj)
-
     tariffs = db_api.tariff_map()
-    process_event(rj, None,  account_id, cost_center_id, rj_datetime, tariffs)
+    ret = event_apply(rj, tariffs)
+
+    db_api.commit()
+    return to_json(ret)
+
+
+@app.route("/v2/events", methods=["POST"])
+def events_create():
+    """
+    Process a batch of events in one transaction.
+
+    The request is either an array of events or an object with
+    ``events`` array and optional ``atomic`` flag (``true`` by default).
+    An atomic batch is committed only if all events are valid.
+    Otherwise, every event is processed in its own savepoint and
+    invalid events are reported without affecting the others.
+    """
+    rj = request_json()
+    if isinstance(rj, list):
+        events, atomic = rj, True
+    else:
+        check_attrs(rj, ("events", ))
+        events, atomic = rj["events"], rj.get("atomic", True)
+        if not isinstance(events, list):
+            raise BadRequest(description="events must be an array")
+    LOG.debug("received %d events" % len(events))
+    return to_json({"atomic": atomic, "events": events_apply(events, atomic)})
 
-    db.session.commit()
-    return to_json({"account_id": account_id,
-                    "rtype": rj["rtype"],
-                    "datetime": rj_datetime,
-                    "name": rj.get("name", None)})
+
+def event_error(ex):
+    if isinstance(ex, BadRequest):
+        return ex.description
+    return "%s: %s" % (ex.__class__.__name__, ex)
+
+
+def events_apply(events, atomic):
+    """
+    Process ``events`` and commit them.
+
+    :returns: a list of results for every event.
+    """
+    tariffs = db_api.tariff_map()
+    results = []
+    for index, event in enumerate(events):
+        if atomic:
+            try:
+                ret = event_apply(event, tariffs)
+            except (BadRequest, TypeError, ValueError) as ex:
+                db_api.rollback()
+                raise BadRequest(
+                    description="event %d: %s" % (index, event_error(ex)))
+        else:
+            savepoint = db_api.begin_nested()
+            try:
+                ret = event_apply(event, tariffs)
+            except Exception as ex:
+                db_api.rollback_nested(savepoint)
+                if isinstance(ex, (BadRequest, TypeError, ValueError)):
+                    status = 400
+                else:
+                    LOG.exception("cannot process event %d" % index)
+                    status = 500
+                results.append({"status": status,
+                                "error": event_error(ex)})
+                continue
+            db.session.commit()
+        ret["status"] = 200
+        results.append(ret)
+
+    db_api.commit()
+    return results
+
+
+def events_write(events):
+    """
+    Process ``events`` outside of a request, e.g., directly from
+    the AMQP listener. Invalid events are skipped.
+    """
+    try:
+        return events_apply(events, False)
+    except:
+        db_api.rollback()
+        raise
+    finally:
+        db_api.pending_clear()
+        db.session.remove()
+
+
+@app.route("/v2/stats", methods=["GET"])
+def stats_get():
+    caches = {"account": db_api.account_cache,
+              "resource": db_api.resource_cache}
+    return to_json({"caches": dict(((name, {
+        "size": len(cache),
+        "max_size": cache.size,
+        "hits": cache.hits,
+        "misses": cache.misses,
+    }) for name, cache in caches.iteritems()))})
 
 
 @app.route("/v1/tariff", methods=["GET"])
 @app.route("/v2/tariff", methods=["GET"])
+@read_only
 def tariff_get():
     tariffs = db_api.tariff_map()
     return to_json(tariffs)
@@ -390,15 +639,14 @@ def tariff_update():
     if migrate:
         old_tariffs = db_api.tariff_map()
     new_tariffs = rj["values"]
-    for key, value in new_tariffs.iteritems():
-        if isinstance(value, int) or isinstance(value, float):
-            db.session.merge(Tariff(rtype=key, multiplier=value))
+    db_api.tariffs_update(new_tariffs)
 
     if migrate:
         db_api.tariffs_migrate(
             old_tariffs,
             new_tariffs,
             rj_datetime)
+        report_cache.touch(rj_datetime)
 
     db.session.commit()
 
@@ -407,23 +655,32 @@ def tariff_update():
 
 @app.route("/v1/account", methods=["GET"])
 @app.route("/v2/account", methods=["GET"])
+@read_only
 def account_get():
-    res = Account.query_filtered()
-    return Account.list_to_json(res.all())
+    res, limit = Account.query_paginated()
+    obj_list = res.all()
+    return set_next_link(Account.list_to_json(obj_list), obj_list, limit)
 
 
 @app.route("/v1/resource", methods=["GET"])
 @app.route("/v2/resource", methods=["GET"])
+@read_only
 def resource_get():
-    res = Resource.query_filtered()
+    res, limit = Resource.query_paginated()
     fld_list = Resource.fld_list()
 
-    def get_rsrc_dict(obj):
-        rsrc_dict = dict(((fld, getattr(obj, fld)) for fld in fld_list))
-        rsrc_dict["attrs"] = obj.get_attrs()
+    def get_rsrc_dict(row):
+        rsrc_dict = dict(((fld, getattr(row, fld)) for fld in fld_list))
+        rsrc_dict["attrs"] = Resource.parse_attrs(row.attrs)
         return rsrc_dict
 
-    return to_json([get_rsrc_dict(obj) for obj in res.all()])
+    if limit is not None:
+        obj_list = res.all()
+        return set_next_link(
+            to_json([get_rsrc_dict(obj) for obj in obj_list]),
+            obj_list, limit)
+    return to_json_stream(iter_json(
+        get_rsrc_dict(row) for row in db_api.iter_query(res)))
 
 
 @app.route("/v1/resource", methods=["POST"])
@@ -433,7 +690,7 @@ def resource_create():
 
     process_resource(rj, None, account_id, cost_center_id)
 
-    db.session.commit()
+    db_api.commit()
     return to_json({"account_id": account_id,
                     "rtype": rj["rtype"],
                     "name": rj.get("name", None)})
@@ -450,7 +707,12 @@ def obj_update_name(cls):
     obj = ret.first()
     obj.name = rj["name"]
     db.session.merge(obj)
+    if cls in (Resource, Account):
+        db_api.identity_version.bump()
     db.session.commit()
+    report_cache.touch()
+    if cls in (Resource, Account):
+        db_api.identity_version.invalidate()
     return obj.to_json()
 
 
@@ -465,6 +727,7 @@ def account_create():
     check_attrs(rj, ("name", "cost_center_name"))
     obj = db_api.account_get_or_create(
         rj["name"], rj["cost_center_name"])
+    db.session.commit()
     return obj.to_json()
 
 
@@ -474,9 +737,12 @@ def account_update():
 
 
 @app.route("/v2/cost_center", methods=["GET"])
+@read_only
 def cost_center_get():
-    res = CostCenter.query_filtered()
-    return CostCenter.list_to_json(res.all())
+    res, limit = CostCenter.query_paginated()
+    obj_list = res.all()
+    return set_next_link(
+        CostCenter.list_to_json(obj_list), obj_list, limit)
 
 
 @app.route("/v2/cost_center", methods=["POST"])
@@ -484,6 +750,7 @@ def cost_center_create():
     rj = request_json()
     check_attrs(rj, ("name", ))
     obj = db_api.cost_center_get_or_create(rj["name"])
+    db.session.commit()
     return obj.to_json()
 
 
@@ -519,5 +786,8 @@ def cost_center_delete():
             cost_center_id=to_delete.id).update(
             {table.cost_center_id: to_migrate.id})
     db.session.delete(to_delete)
+    db_api.identity_version.bump()
     db.session.commit()
+    report_cache.touch()
+    db_api.identity_version.invalidate()
     return Response(status=204)
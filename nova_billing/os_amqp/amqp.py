@@ -28,6 +28,8 @@ import socket
 import logging
 
 import eventlet
+import eventlet.queue
+import eventlet.semaphore
 
 import kombu.entity
 import kombu.messaging
@@ -37,12 +39,88 @@ from nova_billing import utils
 from nova_billing.utils import global_conf
 
 from . import instances
+from . import spool
 from . import volumes
+from .spool import Rejected
 
 
 LOG = logging.getLogger(__name__)
 
 
+class Worker(object):
+    """
+    Green thread posting heart requests to the Heart in batches
+    of ``heart_batch_size`` events or every ``heart_batch_interval``
+    seconds. Messages are acked only when their batch is accepted.
+    """
+    def __init__(self, service):
+        self.service = service
+        self.queue = eventlet.queue.LightQueue()
+        self.buffer = []
+        self.buffered_at = None
+
+    def reset(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except eventlet.queue.Empty:
+                break
+        self.buffer = []
+
+    def run(self):
+        while True:
+            if self.buffer:
+                timeout = max(0, self.buffered_at - time.time() +
+                              global_conf.heart_batch_interval)
+            else:
+                timeout = None
+            try:
+                heart_request, message = self.queue.get(timeout=timeout)
+            except eventlet.queue.Empty:
+                self.flush()
+            else:
+                self.add(heart_request, message)
+
+    def add(self, heart_request, message):
+        if not self.buffer:
+            self.buffered_at = time.time()
+        self.buffer.append((heart_request, message))
+        if len(self.buffer) >= global_conf.heart_batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Post buffered heart requests as one batch. Their messages are
+        acked if the Heart accepts the batch and requeued otherwise.
+        A batch that the Heart rejects is spooled to be moved to
+        the rejected file or, without a spool, dropped.
+        """
+        if not self.buffer:
+            return
+        buffer, self.buffer = self.buffer, []
+        heart_requests = [heart_request for heart_request, message in buffer]
+        spool = self.service.spool
+        if spool is not None and len(spool):
+            # keep the order: new requests wait behind the spooled ones
+            accepted = self.service.spool_append(heart_requests)
+        else:
+            try:
+                accepted = self.service.post(heart_requests)
+            except Rejected:
+                # redelivered, the batch would be rejected again
+                accepted = spool is None
+                if accepted:
+                    LOG.error("dropping %d rejected events: %s" %
+                              (len(heart_requests), heart_requests))
+            if not accepted and spool is not None:
+                accepted = self.service.spool_append(heart_requests)
+        self.service.settle([message for heart_request, message in buffer],
+                            accepted)
+        if not accepted:
+            # do not spin on redelivered messages while the Heart is down
+            time.sleep(1)
+
+
 class Service(object):
     heart_request_interceptors = (
         instances.create_heart_request,
@@ -55,15 +133,39 @@ class Service(object):
     reconnection attempts will be made periodically.
 
     The service listens for ``compute.#`` routing keys.
+
+    Heart requests are handed to a pool of ``amqp_workers`` workers.
+    Requests for the same resource always go to the same worker,
+    so its events reach the Heart in order. At most
+    ``amqp_prefetch_count`` messages are delivered unacked.
+
+    With ``amqp_heart_mode`` set to ``database``, events are written
+    directly to ``heart_db_uri`` instead of being posted to the Heart.
+
+    If ``amqp_spool_file`` is set, batches that the Heart does not
+    accept are stored there and acked. They are replayed in order
+    when the Heart recovers.
     """
     def __init__(self):
-        self.billing_heart = global_conf.clients.billing
+        if global_conf.amqp_heart_mode == "database":
+            from nova_billing.heart import rest
+            self.heart_rest = rest
+        else:
+            self.heart_rest = None
+            self.billing_heart = global_conf.clients.billing
         self.params = dict(hostname=global_conf.rabbit_host,
                           port=global_conf.rabbit_port,
                           userid=global_conf.rabbit_userid,
                           password=global_conf.rabbit_password,
                           virtual_host=global_conf.rabbit_virtual_host)
         self.connection = None
+        self.channel_lock = eventlet.semaphore.Semaphore()
+        self.workers = [Worker(self)
+                        for i in xrange(max(1, global_conf.amqp_workers))]
+        if global_conf.amqp_spool_file:
+            self.spool = spool.Spool(global_conf.amqp_spool_file)
+        else:
+            self.spool = None
 
     def reconnect(self):
         if self.connection:
@@ -72,6 +174,9 @@ class Service(object):
             except self.connection.connection_errors:
                 pass
             time.sleep(1)
+        # unacked messages will be redelivered to the new channel
+        for worker in self.workers:
+            worker.reset()
 
         self.connection = kombu.connection.BrokerConnection(**self.params)
 
@@ -96,17 +201,113 @@ class Service(object):
             **options)
         LOG.debug("Created kombu connection: %s" % self.params)
 
+    def worker_for(self, heart_request):
+        return self.workers[
+            hash(heart_request.get("name")) % len(self.workers)]
+
+    def post(self, heart_requests):
+        """
+        Post ``heart_requests`` to the Heart as one batch
+        or write them to the database in database mode.
+
+        :returns: True if the Heart accepted the batch
+            and False if it could not be reached.
+        :raises: :class:`Rejected` if the Heart refused the batch.
+        """
+        LOG.debug("posting %d events to the Heart" % len(heart_requests))
+        try:
+            if self.heart_rest is not None:
+                self.heart_rest.events_write(heart_requests)
+            else:
+                self.billing_heart.post("/events", body={
+                    "events": heart_requests,
+                    "atomic": False,
+                })
+            return True
+        except socket.error as ex:
+            LOG.error("cannot post events to the Heart: %s" % str(ex))
+        except Exception as ex:
+            if spool.is_rejection(ex):
+                LOG.error("the Heart rejected %d events: %s" %
+                          (len(heart_requests), ex))
+                raise Rejected(str(ex))
+            LOG.exception("cannot post events to the Heart")
+        return False
+
+    def spool_append(self, heart_requests):
+        try:
+            self.spool.append(heart_requests)
+            return True
+        except (IOError, OSError):
+            LOG.exception("cannot spool events")
+            return False
+
+    def replay(self):
+        """
+        Post spooled heart requests in order. This is the main function
+        of the replayer's green thread. Batches that the Heart rejects
+        are moved to the rejected file of the spool, and batches that
+        it cannot take now are retried.
+        """
+        while True:
+            self.replay_batch()
+
+    def replay_batch(self):
+        heart_requests, offset = self.spool.read(
+            global_conf.heart_batch_size)
+        if not heart_requests:
+            eventlet.sleep(global_conf.heart_batch_interval)
+            return
+        started_at = time.time()
+        try:
+            accepted = self.post(heart_requests)
+        except Rejected:
+            self.spool.reject(heart_requests, offset)
+        else:
+            if not accepted:
+                time.sleep(1)
+                return
+            self.spool.replay_rate = len(heart_requests) / max(
+                time.time() - started_at, 0.001)
+            self.spool.commit(offset, len(heart_requests))
+        LOG.info("spool depth=%(depth)d replayed=%(replayed)d "
+                 "rejected=%(rejected)d "
+                 "replay_rate=%(replay_rate).1f/s" % self.spool.stats())
+
+    def settle(self, messages, accepted):
+        """
+        Ack or requeue ``messages``. Workers share one channel,
+        so its writes are serialized.
+        """
+        with self.channel_lock:
+            for message in messages:
+                if message is None:
+                    continue
+                try:
+                    if accepted:
+                        message.ack()
+                    else:
+                        message.requeue()
+                except Exception:
+                    LOG.exception("cannot settle message")
+
     def process_message(self, body, message):
         try:
-            self.process_event(body, message)
+            heart_request = self.process_event(body, message)
         except:
             LOG.exception("Cannot handle message")
-        message.ack()
+            heart_request = None
+        if heart_request is None:
+            self.settle((message, ), True)
+        else:
+            self.worker_for(heart_request).queue.put((heart_request, message))
 
     def process_event(self, body, message):
         """
         This function analyzes ``body`` and calls
         heart_request_interceptors.
+
+        :returns: the heart request for ``body`` or None.
         """
         method = body.get("method", None)
         heart_request = None
@@ -116,22 +317,22 @@ class Service(object):
                 heart_request.setdefault("datetime", utils.datetime_to_str(
                     self.get_event_datetime(body)))
                 heart_request.setdefault("account", body["_context_project_id"])
-                LOG.debug("posting event to the Heart: %s" % heart_request)
-                try:
-                    self.billing_heart.event.create(heart_request)
-                except socket.error as ex:
-                    LOG.error("cannot post event to the Heart: %s" % str(ex))
-                except:
-                    LOG.exception("cannot post event to the Heart")
+                LOG.debug("event for the Heart: %s" % heart_request)
                 break
         try:
             routing_key = message.delivery_info["routing_key"]
-        except AttributeError, KeyError:
+        except (AttributeError, KeyError):
             routing_key = "<unknown>"
         LOG.debug("routing_key=%s method=%s" % (routing_key, method))
+        return heart_request
 
     def get_event_datetime(self, body):
-        return utils.now()
+        """
+        Time of the request that caused the message. It stays
+        the same when the message is redelivered.
+        """
+        return (utils.str_to_datetime(body.get("_context_timestamp")) or
+                utils.now())
 
     def consume(self):
         """
@@ -144,6 +345,7 @@ class Service(object):
                     channel=self.channel,
                     queues=self.queue,
                     callbacks=[self.process_message]) as consumer:
+                    consumer.qos(prefetch_count=global_conf.amqp_prefetch_count)
                     while True:
                         self.connection.drain_events()
             except socket.error:
@@ -152,10 +354,17 @@ class Service(object):
                 LOG.exception('Failed to consume message from queue: %s' % str(e))
 
     def start(self):
+        instances.refresh_flavors()
+        self.pool = [eventlet.spawn(worker.run) for worker in self.workers]
+        self.pool.append(eventlet.spawn(instances.refresh_flavors_forever))
+        if self.spool is not None:
+            self.pool.append(eventlet.spawn(self.replay))
         self.server = eventlet.spawn(self.consume)
 
     def stop(self):
-        self.server.stop()
+        for thread in self.pool:
+            thread.kill()
+        self.server.kill()
 
     def wait(self):
         self.server.wait()
@@ -0,0 +1,110 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Nova Billing
+# Copyright (C) 2010-2012 Grid Dynamics Consulting Services, Inc
+# All Rights Reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of event delivery from the AMQP listener: posting batches
+through the Heart REST API versus writing them to the database
+in-process (``amqp_heart_mode`` set to ``database``).
+
+The REST path is driven by the Flask test client, so the network hop
+is not measured and the real difference is larger.
+
+Usage: python -m nova_billing.os_amqp.benchmark [EVENTS [BATCH_SIZE]]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import tempfile
+
+from nova_billing import utils
+from nova_billing.utils import global_conf
+
+
+def generate_events(count):
+    start = datetime.datetime(2012, 1, 1)
+    for i in xrange(count):
+        yield {
+            "rtype": "nova/instance",
+            "name": "instance-%d" % (i % 500),
+            "account": "account-%d" % (i % 20),
+            "datetime": utils.datetime_to_str(
+                start + datetime.timedelta(seconds=i)),
+            "linear": 1,
+            "children": [
+                {"rtype": "memory_mb", "linear": 512},
+                {"rtype": "vcpus", "linear": 1},
+                {"rtype": "local_gb", "linear": 10},
+            ],
+        }
+
+
+def batches(events, batch_size):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    db_dir = tempfile.mkdtemp()
+    global_conf._conf["heart_db_uri"] = "sqlite:///%s" % os.path.join(
+        db_dir, "benchmark.db")
+    from nova_billing.heart import app, rest
+    from nova_billing.heart.database import db
+    from nova_billing.heart.database import api as db_api
+
+    def post_http(batch):
+        response = client.post(
+            "/v2/events", content_type="application/json",
+            data=json.dumps({"events": batch, "atomic": False}))
+        assert response.status_code == 200, response.data
+
+    client = app.test_client()
+    try:
+        for name, write in (("http", post_http),
+                            ("database", rest.events_write)):
+            db.drop_all()
+            db.create_all()
+            rest.report_cache.clear()
+            db_api.identity_version.invalidate()
+            db_api.tariff_cache.invalidate()
+            started_at = time.time()
+            for batch in batches(generate_events(count), batch_size):
+                write(batch)
+            elapsed = time.time() - started_at
+            print "%-8s %d events in %.2f s, %.0f events/s" % (
+                name, count, elapsed, count / elapsed)
+    finally:
+        shutil.rmtree(db_dir)
+
+
+if __name__ == '__main__':
+    main()
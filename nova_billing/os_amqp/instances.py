@@ -20,6 +20,10 @@
 
 
 import logging
+
+import eventlet
+
+from nova_billing import utils
 from nova_billing.utils import global_conf
 
 
@@ -67,8 +71,22 @@ target_state = {
 }
 
 
-# Cache flavors here
+# Methods changing the flavor of an instance
+resize_methods = (
+    "prep_resize",
+    "resize_instance",
+    "finish_resize",
+    "confirm_resize",
+    "revert_resize",
+    "finish_revert_resize",
+)
+
+
+# Cache flavors here, they are reloaded every flavor_cache_ttl seconds
 flavors = {}
+# Flavors of instances seen in run_instance messages,
+# kept until the instance is resized
+instance_flavors = utils.LRUCache(global_conf.instance_cache_size)
 no_flavor = {
     "name": "<none>",
     "local_gb": 0,
@@ -87,56 +105,100 @@ def get_compute():
     return compute
 
 
+def billing_flavor(flav):
+    b_flav = {"name": flav.name}
+    for compute, billing in flavor_map.iteritems():
+        b_flav[billing] = getattr(flav, compute)
+    return b_flav
+
+
+def refresh_flavors():
+    """
+    Load all flavors with one API call.
+    """
+    global flavors
+    try:
+        flavor_list = get_compute().flavors.list()
+    except:
+        LOG.exception("cannot load flavors")
+        return
+    flavors = dict(((str(flav.id), billing_flavor(flav))
+                    for flav in flavor_list))
+
+
+def refresh_flavors_forever():
+    """
+    Reload flavors every ``flavor_cache_ttl`` seconds.
+    This is the main function of a green thread.
+    """
+    while True:
+        eventlet.sleep(global_conf.flavor_cache_ttl)
+        refresh_flavors()
+
+
 def get_flavor(flavor_id):
     try:
-        return flavors[flavor_id]
+        return flavors[str(flavor_id)]
     except KeyError:
         pass
     try:
         flav = get_compute().flavors.get(flavor_id)
     except:
         return no_flavor
-    b_flav = {"name": flav.name}
-    for compute, billing in flavor_map.iteritems():
-        b_flav[billing] = getattr(flav, compute)
-    flavors[flavor_id] = b_flav
+    b_flav = billing_flavor(flav)
+    flavors[str(flavor_id)] = b_flav
     return b_flav
 
 
 def get_instance_flavor(instance_id):
+    flav = instance_flavors.get(instance_id)
+    if flav is not None:
+        return flav
     try:
-        return get_flavor(
+        flav = get_flavor(
             get_compute().servers.get(
                 instance_id).flavor["id"])
     except:
         return no_flavor
+    instance_flavors[instance_id] = flav
+    return flav
 
 
-def create_heart_request(method, body):
-    try:
-        state = target_state[method]
-    except KeyError:
-        return None
-
-    heart_request = {"rtype": "nova/instance"}
-
+def get_instance_id(body):
     release = getattr(global_conf, "os_release", None)
     checked_keys = {"diablo": ("instance_id", ),
                     "essex": ("instance_uuid", )}
     checked_keys = checked_keys.get(release, ("instance_uuid", "instance_id"))
     for key in checked_keys:
         try:
-            heart_request["name"] = body["args"][key]
-            break
+            return body["args"][key]
         except KeyError:
             pass
-    if "name" not in heart_request:
-        LOG.error("cannot find keys %s (maybe incorrect OpenStack release)" %
-                  (checked_keys, ))
+    LOG.error("cannot find keys %s (maybe incorrect OpenStack release)" %
+              (checked_keys, ))
+    return None
+
+
+def create_heart_request(method, body):
+    if method in resize_methods:
+        instance_id = get_instance_id(body)
+        if instance_id is not None:
+            instance_flavors.pop(instance_id, None)
         return None
 
+    try:
+        state = target_state[method]
+    except KeyError:
+        return None
+
+    instance_id = get_instance_id(body)
+    if instance_id is None:
+        return None
+    heart_request = {"rtype": "nova/instance", "name": instance_id}
+
     child_keys = ("local_gb", "memory_mb", "vcpus")
     if method == "terminate_instance":
+        instance_flavors.pop(heart_request["name"], None)
         heart_request["fixed"] = None
         heart_request["children"] = [
             {"rtype": key, "fixed": None}
@@ -147,6 +209,9 @@ def create_heart_request(method, body):
             flav = body["args"]["request_spec"]["instance_type"]
         except KeyError:
             flav = get_instance_flavor(heart_request["name"])
+        else:
+            instance_flavors[heart_request["name"]] = dict(
+                ((key, flav[key]) for key in ("name", ) + instance_resources))
         if method == "run_instance":
             heart_request["fixed"] = 0
             heart_request["attrs"] = {"instance_type": flav["name"]}
@@ -0,0 +1,213 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Nova Billing
+# Copyright (C) 2010-2012 Grid Dynamics Consulting Services, Inc
+# All Rights Reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Local spool of heart requests
+"""
+
+import os
+import json
+import mmap
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    """
+    The Heart refused a batch because of its content.
+    """
+    pass
+
+
+def is_rejection(ex):
+    """
+    Check if ``ex`` means that the Heart refused the content
+    of a batch (a 4xx status) rather than could not take it now.
+    Such batches will never be accepted and must not be retried.
+    Events that the Heart cannot apply do not fail a non-atomic batch.
+    """
+    status = getattr(ex, "code", None)
+    if not isinstance(status, int):
+        status = getattr(ex, "http_status", None)
+    return (isinstance(status, int) and 400 <= status < 500 and
+            status not in (408, 429))
+
+
+class Spool(object):
+    """
+    Append-only file of heart requests that the Heart could not take.
+    Requests are stored as JSON lines and replayed in order.
+    The offset of the first request that is not replayed yet
+    is kept in ``<filename>.offset``.
+
+    Requests rejected by the Heart and corrupt lines are moved
+    to ``<filename>.rejected``.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset_filename = "%s.offset" % filename
+        self.rejected_filename = "%s.rejected" % filename
+        self.file = open(filename, "ab")
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() and not self.ends_with_newline():
+            # a torn write: end it, so that it is one corrupt line
+            self.file.write("\n")
+            self.file.flush()
+        try:
+            with open(self.offset_filename, "r") as offset_file:
+                self.offset = int(offset_file.read())
+        except (IOError, ValueError):
+            self.offset = 0
+        self.offset = min(self.offset, self.file.tell())
+        self.depth = self.count(self.offset)
+        self.replayed = 0
+        self.rejected = 0
+        self.replay_rate = 0.0
+
+    def ends_with_newline(self):
+        with open(self.filename, "rb") as spool_file:
+            spool_file.seek(-1, os.SEEK_END)
+            return spool_file.read(1) == "\n"
+
+    def __len__(self):
+        return self.depth
+
+    def count(self, offset):
+        if self.file.tell() <= offset:
+            return 0
+        with open(self.filename, "rb") as spool_file:
+            data = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                depth = 0
+                pos = data.find("\n", offset)
+                while pos >= 0:
+                    depth += 1
+                    pos = data.find("\n", pos + 1)
+                return depth
+            finally:
+                data.close()
+
+    def append(self, heart_requests):
+        """
+        Store ``heart_requests`` with a single fsync.
+        """
+        for heart_request in heart_requests:
+            self.file.write(json.dumps(heart_request))
+            self.file.write("\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.depth += len(heart_requests)
+
+    def read(self, limit):
+        """
+        Read up to ``limit`` requests that are not replayed yet.
+        Corrupt lines are skipped and moved to the rejected file.
+
+        :returns: a list of requests and the offset after them.
+        """
+        while self.file.tell() > self.offset:
+            heart_requests, offset, corrupt = self.read_lines(limit)
+            if corrupt is None:
+                return heart_requests, offset
+            LOG.error("moving corrupt spooled line to %s" %
+                      self.rejected_filename)
+            self.write_rejected([corrupt])
+            self.commit(offset, 1, rejected=True)
+        return [], self.offset
+
+    def read_lines(self, limit):
+        """
+        Read up to ``limit`` requests stopping before a corrupt line.
+
+        :returns: a list of requests, the offset after them, and None;
+            or an empty list, the offset after the first line, and
+            that line if it is corrupt.
+        """
+        heart_requests = []
+        with open(self.filename, "rb") as spool_file:
+            data = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = self.offset
+                while len(heart_requests) < limit:
+                    end = data.find("\n", pos)
+                    if end < 0:
+                        break
+                    line = data[pos:end]
+                    try:
+                        heart_request = json.loads(line)
+                    except ValueError:
+                        if heart_requests:
+                            break
+                        return [], end + 1, line
+                    heart_requests.append(heart_request)
+                    pos = end + 1
+            finally:
+                data.close()
+        return heart_requests, pos, None
+
+    def reject(self, heart_requests, offset):
+        """
+        Move ``heart_requests`` read before ``offset``
+        to the rejected file, so that the requests behind
+        them can be replayed.
+        """
+        self.write_rejected([json.dumps(heart_request)
+                             for heart_request in heart_requests])
+        self.commit(offset, len(heart_requests), rejected=True)
+
+    def write_rejected(self, lines):
+        with open(self.rejected_filename, "ab") as rejected_file:
+            for line in lines:
+                rejected_file.write(line)
+                rejected_file.write("\n")
+            rejected_file.flush()
+            os.fsync(rejected_file.fileno())
+
+    def commit(self, offset, count, rejected=False):
+        """
+        Mark ``count`` requests before ``offset`` as replayed
+        (or rejected). The file is truncated when everything is replayed.
+        """
+        self.depth = max(0, self.depth - count)
+        if rejected:
+            self.rejected += count
+        else:
+            self.replayed += count
+        if offset >= self.file.tell():
+            self.file.truncate(0)
+            self.file.seek(0)
+            offset = 0
+        self.offset = offset
+        tmp_filename = "%s.tmp" % self.offset_filename
+        with open(tmp_filename, "w") as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.rename(tmp_filename, self.offset_filename)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "replayed": self.replayed,
+            "rejected": self.rejected,
+            "replay_rate": self.replay_rate,
+        }
@@ -20,19 +20,132 @@
 
 
 import json
+import time
+import Queue
 import logging
-import webob
+import threading
+import webob.dec
 
 from nova_billing import utils
 from nova_billing.utils import global_conf
+from nova_billing.os_amqp.spool import Spool, Rejected, is_rejection
 
 
 LOG = logging.getLogger(__name__)
 
 
+class HeartReporter(object):
+    """
+    Background thread posting events to the Heart in batches,
+    so that Glance requests do not wait for billing.
+
+    The queue holds up to ``glance_queue_size`` events, and new events
+    are dropped when it is full. Batches that the Heart does not accept
+    are spilled to ``glance_spool_file`` if it is set and replayed later;
+    otherwise, they are dropped. Batches that the Heart refuses are moved
+    to the rejected file of the spool.
+    """
+    def __init__(self, billing_heart):
+        self.billing_heart = billing_heart
+        self.queue = Queue.Queue(global_conf.glance_queue_size)
+        if global_conf.glance_spool_file:
+            self.spool = Spool(global_conf.glance_spool_file)
+        else:
+            self.spool = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, heart_request):
+        try:
+            self.queue.put_nowait(heart_request)
+        except Queue.Full:
+            LOG.error("billing queue is full, dropping %s" % heart_request)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(
+                    timeout=global_conf.heart_batch_interval
+                    if self.spool is not None and len(self.spool) else None)]
+            except Queue.Empty:
+                self.replay()
+                continue
+            deadline = time.time() + global_conf.heart_batch_interval
+            while len(batch) < global_conf.heart_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            self.send(batch)
+
+    def post(self, heart_requests):
+        """
+        :returns: True if the Heart accepted the batch
+            and False if it could not be reached.
+        :raises: :class:`Rejected` if the Heart refused the batch.
+        """
+        try:
+            self.billing_heart.post("/events", body={
+                "events": heart_requests,
+                "atomic": False,
+            })
+            return True
+        except Exception as ex:
+            if is_rejection(ex):
+                LOG.error("the Heart rejected %d billing events: %s" %
+                          (len(heart_requests), ex))
+                raise Rejected(str(ex))
+            LOG.exception("cannot report image info for billing")
+            return False
+
+    def send(self, heart_requests):
+        if self.spool is not None and len(self.spool):
+            # keep the order: new events wait behind the spooled ones
+            self.spill(heart_requests)
+            self.replay()
+            return
+        try:
+            accepted = self.post(heart_requests)
+        except Rejected:
+            if self.spool is not None:
+                self.spool.write_rejected([json.dumps(heart_request)
+                                           for heart_request in heart_requests])
+            return
+        if not accepted:
+            self.spill(heart_requests)
+
+    def spill(self, heart_requests):
+        if self.spool is None:
+            LOG.error("dropping %d billing events" % len(heart_requests))
+            return
+        try:
+            self.spool.append(heart_requests)
+        except (IOError, OSError):
+            LOG.exception("dropping %d billing events" % len(heart_requests))
+
+    def replay(self):
+        while len(self.spool):
+            heart_requests, offset = self.spool.read(
+                global_conf.heart_batch_size)
+            if not heart_requests:
+                break
+            try:
+                accepted = self.post(heart_requests)
+            except Rejected:
+                self.spool.reject(heart_requests, offset)
+                continue
+            if not accepted:
+                break
+            self.spool.commit(offset, len(heart_requests))
+
+
 class GlanceBillingFilter(object):
     def __init__(self, application):
-        self.billing_heart = global_conf.clients.billing
+        self.reporter = HeartReporter(global_conf.clients.billing)
         self.application = application
 
     @webob.dec.wsgify
@@ -59,10 +172,7 @@ class GlanceBillingFilter(object):
             heart_request["rtype"] = "glance/image"
             heart_request["account"] = req.headers["X-Tenant-Id"]
             heart_request["datetime"] = utils.datetime_to_str(utils.now())
-            try:
-                self.billing_heart.event.create(heart_request)
-            except:
-                LOG.exception("cannot report image info for billing")
+            self.reporter.put(heart_request)
         return resp
 
     @classmethod
@@ -19,17 +19,23 @@
 # <http://www.gnu.org/licenses/>.
 
 
+import datetime
 import json
 import logging
 import sys
 
 from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import CreateIndex, DropIndex
+from sqlalchemy.sql import func, select
 from flask import _request_ctx_stack
 
 from nova_billing import utils
 from nova_billing.utils import global_conf
 from nova_billing.heart.database import db
 from nova_billing.heart.database import api as db_api
+from nova_billing.heart.database import models
 from nova_billing.heart.database.models import Segment, Resource
 
 from nova_billing.os_amqp.instances import instance_resources, flavor_map
@@ -39,7 +45,7 @@ LOG = logging.getLogger(__name__)
 
 
 
-usage = "usage: nova-billing-migrate glance|nova|billing_v1 [URI]"
+usage = "usage: nova-billing-populate sync|upgrade|open_segments|rollup|archive|compact|breakpoints|glance|nova|billing_v1 [URI]"
 
 
 def complain_usage():
@@ -57,7 +63,19 @@ def main():
     db.create_all()
     if sys.argv[1] == "sync":
         return
-    if sys.argv[1] == "glance":
+    if sys.argv[1] == "upgrade":
+        upgrade()
+    elif sys.argv[1] == "open_segments":
+        rebuild_open_segments()
+    elif sys.argv[1] == "rollup":
+        rollup()
+    elif sys.argv[1] == "archive":
+        archive()
+    elif sys.argv[1] == "compact":
+        compact()
+    elif sys.argv[1] == "breakpoints":
+        rebuild_breakpoints()
+    elif sys.argv[1] == "glance":
         migrate_glance()
     elif sys.argv[1] == "nova":
         migrate_nova()
@@ -92,6 +110,151 @@ def check_skip_on_exists(resource):
         return True
 
 
+def upgrade():
+    """
+    Create indexes that were added to the models after the database
+    had been created (``db.create_all()`` never alters existing tables).
+    On PostgreSQL, indexes are built concurrently without
+    blocking writes. Indexes that became unique are recreated
+    if the table has no duplicates.
+    """
+    engine = db.engine
+    dialect = engine.dialect.name
+    connection = engine.connect()
+    dbapi_connection = connection.connection
+    if dialect == "postgresql":
+        concurrently = "CONCURRENTLY"
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.set_isolation_level(0)
+    else:
+        concurrently = ""
+    inspector = Inspector.from_engine(engine)
+
+    def create_index(name, ddl):
+        LOG.info("creating index %s" % name)
+        connection.execute(ddl)
+
+    def index_ddl(index):
+        ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+        return ddl.replace(" INDEX ", " INDEX %s " % concurrently, 1)
+
+    def make_unique(index):
+        columns = list(index.columns)
+        duplicates = connection.execute(
+            select(columns + [func.count()]).group_by(*columns).
+            having(func.count() > 1).limit(10)).fetchall()
+        if duplicates:
+            LOG.warning("index %s should be unique; remove duplicates"
+                        " of %s and run upgrade again" %
+                        (index.name, ", ".join(
+                            repr(tuple(row[:-1])) for row in duplicates)))
+            return
+        LOG.info("making index %s unique" % index.name)
+        connection.execute(DropIndex(index))
+        try:
+            connection.execute(index_ddl(index))
+        except IntegrityError:
+            # duplicates were inserted meanwhile
+            LOG.warning("index %s should be unique; remove duplicates"
+                        " and run upgrade again" % index.name)
+            if concurrently:
+                # a failed concurrent build leaves an invalid index
+                connection.execute(DropIndex(index))
+            connection.execute(index_ddl(index).replace(
+                " UNIQUE ", " ", 1))
+
+    for table in db.metadata.sorted_tables:
+        existing = dict(((index["name"], index)
+                         for index in inspector.get_indexes(table.name)))
+        for index in table.indexes:
+            try:
+                existing_index = existing[index.name]
+            except KeyError:
+                create_index(index.name, index_ddl(index))
+                continue
+            if index.unique and not existing_index["unique"]:
+                make_unique(index)
+        if table.name == Segment.__tablename__ and \
+                dialect in models.partial_index_dialects:
+            for name, ddl in models.partial_indexes.iteritems():
+                if name not in existing:
+                    create_index(name, ddl % {"concurrently": concurrently})
+    if dialect == "postgresql":
+        dbapi_connection.set_isolation_level(isolation_level)
+    connection.close()
+
+
+def rebuild_open_segments():
+    """
+    Fill ``open_segment`` from open segments of ``segment``.
+    The Heart must be stopped meanwhile.
+    """
+    db_api.open_segments_rebuild()
+    db.session.commit()
+    LOG.info("filled %d open segments" %
+             models.OpenSegment.query.count())
+
+
+def rollup():
+    batch_size = global_conf.rollup_batch_size
+    total = 0
+    while True:
+        count = db_api.rollup_segments(batch_size)
+        total += count
+        if count < batch_size:
+            break
+    LOG.info("rolled up %d segments" % total)
+
+
+def archive():
+    """
+    Move segments that ended before the last ``archive_months``
+    months to monthly archive tables.
+    """
+    # archived linear segments must be rolled up
+    rollup()
+    now = utils.now()
+    month = now.year * 12 + now.month - 1 - global_conf.archive_months
+    before = datetime.datetime(month // 12, month % 12 + 1, 1)
+    batch_size = global_conf.archive_batch_size
+    total = 0
+    while True:
+        count = db_api.segments_archive(before, batch_size)
+        total += count
+        if count < batch_size:
+            break
+    LOG.info("archived %d segments ended before %s" % (total, before))
+
+
+def compact():
+    batch_size = global_conf.compact_batch_size
+    total = 0
+    # chains cut by a portion boundary are merged on the next pass
+    while True:
+        after_id = 0
+        removed = 0
+        while after_id is not None:
+            count, after_id = db_api.segments_compact(after_id, batch_size)
+            removed += count
+        if not removed:
+            break
+        total += removed
+    LOG.info("merged %d segments" % total)
+
+
+def rebuild_breakpoints():
+    batch_size = global_conf.rollup_batch_size
+    resource_ids = [rsrc_id for rsrc_id, in
+                    db.session.query(Resource.id).order_by(Resource.id)]
+    for index, rsrc_id in enumerate(resource_ids):
+        db_api.breakpoints_rebuild(rsrc_id)
+        if (index + 1) % batch_size == 0:
+            db.session.commit()
+    db.session.commit()
+    LOG.info("rebuilt breakpoints of %d resources" % len(resource_ids))
+
+
 def migrate_glance():
     client = global_conf.clients.image
     tariffs = db_api.tariff_map()
@@ -119,6 +282,7 @@ def migrate_glance():
             end_at=utils.str_to_datetime(img1.deleted_at))
         db.session.add(seg)
 
+    db_api.open_segments_rebuild()
     db.session.commit()
 
 
@@ -175,6 +339,7 @@ def migrate_nova():
             counter += 1
             if counter % 32 == 0:
                 db.session.commit()
+    db_api.open_segments_rebuild()
     db.session.commit()
 
 
@@ -250,6 +415,7 @@ def migrate_billing_v1(old_db_url):
             end_at=inst_dict.get("end_at", None))
         db.session.add(seg)
 
+    db_api.open_segments_rebuild()
     db.session.commit()
 
 
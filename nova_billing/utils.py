@@ -63,6 +63,8 @@ def now():
 def str_to_datetime(dtstr):
     """
     Convert string to datetime.datetime. String should be in ISO 8601 format.
+    Fractional seconds are dropped since costs are counted
+    for whole seconds.
     The function returns ``None`` for invalid date string.
     """
     if not dtstr:
@@ -74,7 +76,7 @@ def str_to_datetime(dtstr):
                 "%Y-%m-%d %H:%M:%S",
                 "%Y-%m-%d %H:%M:%S.%f"):
         try:
-            return datetime.strptime(dtstr, fmt)
+            return datetime.strptime(dtstr, fmt).replace(microsecond=0)
         except ValueError:
             pass
     return None
@@ -103,9 +105,92 @@ def dict_add(a, b):
         a[key] = a.get(key, 0) + b[key]
 
 
+# 31556952 seconds - an average Gregorian year
+YEAR_SECONDS = 31556952.0
+
+
 def cost_add(cost, begin_at, end_at):
-    # 31556952 seconds - an average Gregorian year
-    return cost if cost < 0 else cost * total_seconds(end_at - begin_at) / 31556952.0
+    return cost if cost < 0 else cost * total_seconds(end_at - begin_at) / YEAR_SECONDS
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache holding at most ``size`` items.
+    The least recently used item is evicted when the cache is full.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        # circular doubly linked list of [prev, next, key, value],
+        # the most recently used item follows the root
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _link(self, link):
+        root = self._root
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def get(self, key, default=None):
+        try:
+            link = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(link)
+        self._link(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        try:
+            link = self._items[key]
+        except KeyError:
+            if len(self._items) >= self.size:
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._items[oldest[2]]
+            link = [None, None, key, value]
+            self._items[key] = link
+        else:
+            self._unlink(link)
+            link[3] = value
+        self._link(link)
+
+    def __delitem__(self, key):
+        self._unlink(self._items.pop(key))
+
+    def pop(self, key, default=None):
+        try:
+            link = self._items.pop(key)
+        except KeyError:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def keys(self):
+        return self._items.keys()
+
+    def clear(self):
+        self._items.clear()
+        self._root[:] = [self._root, self._root, None, None]
 
 
 class GlobalConf(object):
@@ -116,6 +201,38 @@ class GlobalConf(object):
         "log_format": "%(asctime)-15s:nova-billing:%(levelname)s:%(name)s:%(message)s",
         "log_level": "DEBUG",
         "heart_db_uri": "",
+        "heart_db_read_uri": "",
+        "heart_db_pool_size": None,
+        "heart_db_max_overflow": None,
+        "heart_db_pool_timeout": None,
+        "heart_db_pool_recycle": None,
+        "heart_db_pre_ping": False,
+        "report_engine": "sql",
+        "rollup_batch_size": 1000,
+        "archive_months": 12,
+        "archive_batch_size": 1000,
+        "compact_batch_size": 1000,
+        "report_cache_size": 128,
+        "report_cache_item_size": 1048576,
+        "report_cache_ttl": 60,
+        "tariff_check_interval": 10,
+        "resource_cache_size": 10000,
+        "account_cache_size": 1000,
+        "page_limit_max": 1000,
+        "heart_batch_size": 100,
+        "heart_batch_interval": 1.0,
+        "amqp_workers": 4,
+        "amqp_prefetch_count": 400,
+        "amqp_spool_file": "",
+        "amqp_heart_mode": "http",
+        "flavor_cache_ttl": 600,
+        "instance_cache_size": 10000,
+        "glance_queue_size": 1000,
+        "glance_spool_file": "",
+        "heart_workers": 1,
+        "heart_worker_connections": 1000,
+        "heart_keepalive": True,
+        "heart_graceful_timeout": 30,
         "keystone_conf": {},
     }
 
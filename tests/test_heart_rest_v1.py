@@ -42,6 +42,7 @@ from nova_billing import utils
 
 from nova_billing.heart import app
 from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
 
 
 class TestCase(tests.TestCase):
@@ -53,6 +54,9 @@ class TestCase(tests.TestCase):
         app.config['TESTING'] = True
         self.app_client = app.test_client()
         db.create_all()
+        db_api.tariff_cache.invalidate()
+        db_api.resource_cache.clear()
+        db_api.account_cache.clear()
 
     def tearDown(self):
         os.close(self.db_fd)
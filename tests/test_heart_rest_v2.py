@@ -25,6 +25,7 @@ Tests for nova_billing.rest
 
 import os
 import sys
+import copy
 import json
 import datetime
 import unittest
@@ -40,8 +41,11 @@ import tests
 
 from nova_billing import utils
 
-from nova_billing.heart import app
+from nova_billing.heart import app, rest
 from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
+from nova_billing.heart.database.models import Account, Resource, \
+     Segment, OpenSegment, SegmentArchive
 
 
 class TestCase(tests.TestCase):
@@ -53,6 +57,9 @@ class TestCase(tests.TestCase):
         app.config['TESTING'] = True
         self.app_client = app.test_client()
         db.create_all()
+        db_api.tariff_cache.invalidate()
+        db_api.identity_version.invalidate()
+        rest.report_cache.clear()
 
     def tearDown(self):
         os.close(self.db_fd)
@@ -118,6 +125,20 @@ class TestCase(tests.TestCase):
                     content_type=utils.ContentType.JSON)
                 self.assertSuccess(res)
 
+    def post_fractional_events(self):
+        self.create_accounts()
+        self.create_tariffs()
+        for linear, dt in ((1, "2011-01-02T10:00:00.300000Z"),
+                           (2, "2011-01-03T05:00:00.800000Z"),
+                           (3, "2011-01-04T20:00:00.900000Z")):
+            res = self.app_client.post(
+                "/v2/event",
+                data=json.dumps({"rtype": "nova/volume", "name": "vol",
+                                 "account": "systenant", "linear": linear,
+                                 "datetime": dt}),
+                content_type=utils.ContentType.JSON)
+            self.assertSuccess(res)
+
     def fake_now(self):
         return datetime.datetime(2011, 1, 1)
 
@@ -146,8 +167,551 @@ class TestCase(tests.TestCase):
         self.feed_requests("rest.v2/resource_get.json")
         self.feed_requests("rest.v2/resource_update.json")
 
+    def test_stats(self):
+        self.populate_db()
+        res = self.app_client.get("/v2/stats")
+        self.assertSuccess(res)
+        resource_stats = json.loads(res.data)["caches"]["resource"]
+        self.assertTrue(resource_stats["size"] > 0)
+        self.assertTrue(resource_stats["hits"] > 0)
+
+    def test_resource_pages(self):
+        self.populate_db()
+        res = self.app_client.get("/v2/resource?account_id=1")
+        self.assertSuccess(res)
+        expected = sorted(json.loads(res.data), key=lambda rsrc: rsrc["id"])
+        rsrc_list = []
+        uri = "/v2/resource?account_id=1&limit=4"
+        while uri:
+            res = self.app_client.get(uri)
+            self.assertSuccess(res)
+            page = json.loads(res.data)
+            self.assertTrue(len(page) <= 4)
+            rsrc_list.extend(page)
+            link = res.headers.get("Link", None)
+            uri = link[link.index("/v2/"):link.index(">")] if link else None
+        self.assertEqual(rsrc_list, expected)
+        res = self.app_client.get("/v2/resource?limit=0")
+        self.assertEqual(res.status_code, 400)
+        self.stubs.Set(utils.GlobalConf, "_conf", dict(
+            utils.global_conf._conf, page_limit_max=2))
+        res = self.app_client.get("/v2/resource?limit=1000000")
+        self.assertSuccess(res)
+        self.assertEqual(len(json.loads(res.data)), 2)
+        self.assertTrue("Link" in res.headers)
+        self.stubs.UnsetAll()
+
     def test_report(self):
         self.stubs.Set(utils, "now", self.fake_now)
         self.populate_db()
         self.feed_requests("rest.v2/report_get.json")
         self.stubs.UnsetAll()
+
+    def test_report_python(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf, report_engine="python"))
+        self.populate_db()
+        self.feed_requests("rest.v2/report_get.json")
+        self.stubs.UnsetAll()
+
+    def test_report_integral(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf, report_engine="integral"))
+        self.populate_db()
+        self.feed_requests("rest.v2/report_get.json")
+        with app.test_request_context():
+            for rsrc in Resource.query.all():
+                db_api.breakpoints_rebuild(rsrc.id)
+            db.session.commit()
+        rest.report_cache.clear()
+        self.feed_requests("rest.v2/report_get.json")
+        res = self.app_client.post(
+            "/v2/tariff",
+            data=json.dumps({"migrate": True,
+                             "values": {"memory_mb": 2.0},
+                             "datetime": "2011-01-13T00:00:00Z"}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        for uri in ("/v2/report?time_period=2011",
+                    "/v2/report?time_period=2011-01",
+                    "/v2/report?period_start=2011-01-03T12:00:00Z"
+                    "&period_end=2011-01-13T06:00:00Z"):
+            self.assertReportAlmostEqual(
+                self.get_report(uri, "integral"),
+                self.get_report(uri, "sql"))
+
+    def test_report_fractional_seconds(self):
+        self.create_accounts()
+        self.create_tariffs()
+        res = self.app_client.post(
+            "/v2/event",
+            data=json.dumps({"rtype": "nova/volume", "name": "vol",
+                             "account": "systenant", "linear": 1,
+                             "datetime": "2011-01-02T00:00:00Z"}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        with app.test_request_context():
+            OpenSegment.query.delete()
+            Segment.query.update({
+                "begin_at": datetime.datetime(2011, 1, 2, 0, 0, 0, 999600),
+                "end_at": datetime.datetime(2011, 1, 2, 0, 0, 10)})
+            db.session.commit()
+        uri = ("/v2/report?period_start=2011-01-02T00:00:00Z"
+               "&period_end=2011-01-03T00:00:00Z")
+        for report_engine in ("sql", "python"):
+            report = self.get_report(uri, report_engine)
+            self.assertEqual(
+                [rsrc["cost"]
+                 for acc in report["accounts"]
+                 for rsrc in acc["resources"]],
+                [9.0])
+
+    def test_report_integral_fractional_seconds(self):
+        self.post_fractional_events()
+        with app.test_request_context():
+            for rsrc in Resource.query.all():
+                db_api.breakpoints_rebuild(rsrc.id)
+            db.session.commit()
+        for uri in ("/v2/report?time_period=2011",
+                    "/v2/report?time_period=2011-01-03",
+                    "/v2/report?period_start=2011-01-02T12:00:00.500000Z"
+                    "&period_end=2011-01-04T06:00:00.100000Z"):
+            self.assertReportAlmostEqual(
+                self.get_report(uri, "integral"),
+                self.get_report(uri, "sql"))
+
+    def test_report_out_of_order(self):
+        self.create_accounts()
+        self.create_tariffs()
+        for name, linear, fixed, dt in (
+                ("vol", 1, None, "2012-01-10T00:00:00Z"),
+                ("vol", 2, None, "2012-01-05T00:00:00Z"),
+                ("img", None, 3, "2012-01-20T00:00:00Z"),
+                ("img", None, 5, "2012-01-15T00:00:00Z"),
+                ("img", None, None, "2012-02-03T00:00:00Z"),
+                ("vol", 3, None, "2012-02-02T00:00:00Z")):
+            event = {"rtype": "nova/volume", "name": name,
+                     "account": "systenant", "datetime": dt}
+            if linear is not None:
+                event["linear"] = linear
+            else:
+                event["fixed"] = fixed
+            res = self.app_client.post(
+                "/v2/event",
+                data=json.dumps(event),
+                content_type=utils.ContentType.JSON)
+            self.assertSuccess(res)
+        with app.test_request_context():
+            self.assertTrue(Segment.query.filter(
+                Segment.end_at < Segment.begin_at).count())
+            db_api.rollup_segments()
+            for rsrc in Resource.query.all():
+                db_api.breakpoints_rebuild(rsrc.id)
+            db.session.commit()
+        for uri in ("/v2/report?time_period=2012",
+                    "/v2/report?time_period=2012-01",
+                    "/v2/report?time_period=2012-01-07",
+                    "/v2/report?period_start=2012-01-04T12:00:00Z"
+                    "&period_end=2012-01-12T00:00:00Z",
+                    "/v2/report?period_start=2012-01-06T00:00:00Z"
+                    "&period_end=2012-01-25T00:00:00Z",
+                    "/v2/report?period_start=2012-01-12T00:00:00Z"
+                    "&period_end=2012-02-10T00:00:00Z"):
+            expected = self.get_report(uri, "sql")
+            for report_engine in ("python", "numpy", "rollup", "integral"):
+                self.assertReportAlmostEqual(
+                    self.get_report(uri, report_engine),
+                    copy.deepcopy(expected))
+
+    def test_open_segments(self):
+        def open_segments():
+            with app.test_request_context():
+                segments = sorted(
+                    (seg.id, seg.resource_id, seg.cost, seg.begin_at)
+                    for seg in Segment.query.filter_by(end_at=None))
+                self.assertEqual(segments, sorted(
+                    (seg.segment_id, seg.resource_id, seg.cost, seg.begin_at)
+                    for seg in OpenSegment.query))
+                return segments
+
+        self.populate_db()
+        before = open_segments()
+        res = self.app_client.post(
+            "/v2/tariff",
+            data=json.dumps({"migrate": True,
+                             "values": {"memory_mb": 2.0},
+                             "datetime": "2011-01-13T00:00:00Z"}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        after = open_segments()
+        self.assertNotEqual(after, before)
+        self.assertEqual(len(after), len(before))
+
+    def test_open_segments_ensure(self):
+        self.populate_db()
+        with app.test_request_context():
+            open_count = OpenSegment.query.count()
+            self.assertTrue(open_count)
+            self.assertFalse(db_api.open_segments_ensure())
+            OpenSegment.query.delete()
+            db.session.commit()
+            self.assertTrue(db_api.open_segments_ensure())
+            self.assertEqual(OpenSegment.query.count(), open_count)
+
+    def test_segments_archive(self):
+        self.populate_db()
+        with app.test_request_context():
+            while db_api.rollup_segments(limit=4):
+                pass
+        uris = ("/v2/report?time_period=2011",
+                "/v2/report?time_period=2011-01",
+                "/v2/report?period_start=2011-01-03T12:00:00Z"
+                "&period_end=2011-01-07T06:00:00Z",
+                "/v2/report?period_start=2011-01-07T12:00:00Z"
+                "&period_end=2011-01-20T00:00:00Z")
+        engines = ("sql", "python", "numpy", "rollup")
+        reports = dict((((uri, engine), self.get_report(uri, engine))
+                        for uri in uris for engine in engines))
+
+        archive_before = datetime.datetime(2011, 1, 8)
+        with app.test_request_context():
+            while db_api.segments_archive(archive_before, limit=3):
+                pass
+            self.assertEqual(Segment.query.filter(
+                Segment.end_at < archive_before).count(), 0)
+            self.assertEqual([archive.month
+                              for archive in SegmentArchive.query],
+                             [datetime.date(2011, 1, 1)])
+            self.assertEqual(db_api.archived_segments(
+                datetime.datetime(2011, 2, 1)), None)
+            for rsrc in Resource.query.all():
+                db_api.breakpoints_rebuild(rsrc.id)
+            db.session.commit()
+
+        for (uri, engine), report in reports.iteritems():
+            for first, second in ((self.get_report(uri, engine),
+                                   copy.deepcopy(report)),
+                                  (self.get_report(uri, "integral"),
+                                   copy.deepcopy(reports[uri, "sql"]))):
+                for acc in first["accounts"] + second["accounts"]:
+                    acc["resources"].sort(key=lambda rsrc: rsrc["id"])
+                self.assertReportAlmostEqual(first, second)
+
+    def test_segments_compact(self):
+        self.populate_db()
+        with app.test_request_context():
+            while db_api.rollup_segments(limit=4):
+                pass
+            segment_count = Segment.query.count()
+        uris = ("/v2/report?time_period=2011",
+                "/v2/report?time_period=2011-01",
+                "/v2/report?period_start=2011-01-03T12:00:00Z"
+                "&period_end=2011-01-07T06:00:00Z")
+        engines = ("sql", "python", "numpy", "rollup")
+        reports = dict((((uri, engine), self.get_report(uri, engine))
+                        for uri in uris for engine in engines))
+
+        with app.test_request_context():
+            removed = None
+            while removed != 0:
+                after_id = 0
+                removed = 0
+                while after_id is not None:
+                    count, after_id = db_api.segments_compact(
+                        after_id, limit=2)
+                    removed += count
+            self.assertTrue(Segment.query.count() < segment_count)
+
+        for (uri, engine), report in reports.iteritems():
+            compacted = self.get_report(uri, engine)
+            for first in report, compacted:
+                for acc in first["accounts"]:
+                    acc["resources"].sort(key=lambda rsrc: rsrc["id"])
+            if "period_start" in uri:
+                # resources are not created or destroyed inside the period
+                for first in report, compacted:
+                    for acc in first["accounts"]:
+                        for rsrc in acc["resources"]:
+                            del rsrc["created_at"], rsrc["destroyed_at"]
+            self.assertReportAlmostEqual(compacted, report)
+
+    def get_report(self, uri, report_engine):
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf,
+                            report_engine=report_engine))
+        rest.report_cache.clear()
+        res = self.app_client.get(uri)
+        self.stubs.UnsetAll()
+        self.assertSuccess(res)
+        return json.loads(res.data)
+
+    def assertReportAlmostEqual(self, first, second):
+        first_costs = [rsrc.pop("cost")
+                       for acc in first["accounts"]
+                       for rsrc in acc["resources"]]
+        second_costs = [rsrc.pop("cost")
+                        for acc in second["accounts"]
+                        for rsrc in acc["resources"]]
+        self.assertEqual(first, second)
+        for first_cost, second_cost in zip(first_costs, second_costs):
+            self.assertAlmostEqual(first_cost, second_cost, places=6)
+
+    def test_report_rollup(self):
+        self.populate_db()
+        with app.test_request_context():
+            while db_api.rollup_segments(limit=4):
+                pass
+        for uri in ("/v2/report?time_period=2011",
+                    "/v2/report?time_period=2011-01-05",
+                    "/v2/report?period_start=2011-01-03T12:00:00Z"
+                    "&period_end=2011-01-07T06:00:00Z"):
+            self.assertReportAlmostEqual(
+                self.get_report(uri, "rollup"),
+                self.get_report(uri, "sql"))
+
+    def test_report_rollup_fractional_seconds(self):
+        self.post_fractional_events()
+        with app.test_request_context():
+            db_api.rollup_segments()
+        for uri in ("/v2/report?time_period=2011",
+                    "/v2/report?period_start=2011-01-02T12:00:00.500000Z"
+                    "&period_end=2011-01-04T06:00:00.100000Z"):
+            self.assertReportAlmostEqual(
+                self.get_report(uri, "rollup"),
+                self.get_report(uri, "sql"))
+
+    def test_report_numpy(self):
+        self.populate_db()
+        for uri in ("/v2/report?time_period=2011",
+                    "/v2/report?time_period=2011-01-05",
+                    "/v2/report?period_start=2011-01-03T12:00:00Z"
+                    "&period_end=2011-01-07T06:00:00Z"):
+            reports = [self.get_report(uri, report_engine)
+                       for report_engine in ("numpy", "python")]
+            for report in reports:
+                for acc in report["accounts"]:
+                    acc["resources"].sort(key=lambda rsrc: rsrc["id"])
+            self.assertReportAlmostEqual(*reports)
+
+    def test_report_cache(self):
+        self.populate_db()
+        uri = "/v2/report?time_period=2011"
+        res = self.app_client.get(uri)
+        self.assertSuccess(res)
+        # the report is cached when its streaming is over
+        body = res.data
+        self.assertEqual(len(rest.report_cache.reports), 1)
+        self.assertEqual(self.app_client.get(uri).data, body)
+        key = rest.report_cache.reports.keys()[0]
+        self.stubs.Set(rest.report_cache, "ttl", -1)
+        self.assertEqual(rest.report_cache.get(key), None)
+        self.stubs.UnsetAll()
+        self.assertEqual(self.app_client.get(uri).data, body)
+        for event_datetime, cached in (("2012-01-01T00:00:00Z", 1),
+                                       ("2011-06-01T00:00:00Z", 0)):
+            res = self.app_client.post(
+                "/v2/event",
+                data=json.dumps({"rtype": "nova/volume",
+                                 "name": "cached",
+                                 "account": "systenant",
+                                 "linear": 1,
+                                 "datetime": event_datetime}),
+                content_type=utils.ContentType.JSON)
+            self.assertSuccess(res)
+            self.assertEqual(len(rest.report_cache.reports), cached)
+
+    def test_report_cache_snapshot(self):
+        cache = rest.report_cache
+        period_end = datetime.datetime(2012, 1, 1)
+        key = cache.key("v2", datetime.datetime(2011, 1, 1), period_end, {})
+        # writes after the period do not prevent caching
+        snapshot = cache.snapshot()
+        cache.touch(datetime.datetime(2012, 1, 1))
+        cache.touch(datetime.datetime(2012, 3, 1))
+        cache.put(key, snapshot, "report")
+        self.assertEqual(cache.get(key), "report")
+        for touched_at in (datetime.datetime(2011, 12, 31), None):
+            cache.clear()
+            snapshot = cache.snapshot()
+            cache.touch(datetime.datetime(2012, 2, 1))
+            cache.touch(touched_at)
+            cache.put(key, snapshot, "report")
+            self.assertEqual(cache.get(key), None)
+        # only reports on periods ending after the write are dropped
+        later_key = cache.key(
+            "v2", datetime.datetime(2012, 1, 1),
+            datetime.datetime(2012, 2, 1), {})
+        cache.put(key, cache.snapshot(), "report")
+        cache.put(later_key, cache.snapshot(), "later")
+        self.assertEqual(cache.period_ends,
+                         [period_end, datetime.datetime(2012, 2, 1)])
+        cache.touch(datetime.datetime(2012, 1, 15))
+        self.assertEqual(cache.get(key), "report")
+        self.assertEqual(cache.get(later_key), None)
+        self.assertEqual(cache.period_ends, [period_end])
+
+    def test_report_connection(self):
+        self.populate_db()
+        with app.test_request_context():
+            db_api.rollup_segments()
+            engine = db.engine
+        connections = []
+        connect = engine.connect
+
+        def fake_connect():
+            connections.append(connect())
+            return connections[-1]
+
+        self.stubs.Set(engine, "connect", fake_connect)
+        for report_engine in ("sql", "rollup"):
+            self.stubs.Set(utils.GlobalConf, "_conf",
+                           dict(utils.global_conf._conf,
+                                report_engine=report_engine))
+            rest.report_cache.clear()
+            del connections[:]
+            res = self.app_client.get("/v2/report?time_period=2011")
+            self.assertSuccess(res)
+            self.assertTrue(json.loads(res.data)["accounts"])
+            self.assertEqual(len(connections), 1)
+            self.assertTrue(connections[0].closed)
+        self.stubs.UnsetAll()
+
+    def test_read_replica(self):
+        replica_fd, replica_filename = tempfile.mkstemp()
+        self.stubs.Set(utils.GlobalConf, "_conf", dict(
+            utils.global_conf._conf,
+            heart_db_read_uri="sqlite:////" + replica_filename))
+        app.config['SQLALCHEMY_BINDS'] = {
+            "read": utils.global_conf.heart_db_read_uri}
+        try:
+            db.metadata.create_all(db.get_engine(app, "read"))
+            self.create_accounts()
+            res = self.app_client.get("/v2/account")
+            self.assertSuccess(res)
+            self.assertEqual(json.loads(res.data), [])
+            # tariffs and cache versions are read from the primary
+            self.create_tariffs()
+            db_api.tariff_cache.invalidate()
+            res = self.app_client.get("/v2/tariff")
+            self.assertSuccess(res)
+            self.assertNotEqual(json.loads(res.data), {})
+            self.assertEqual(db_api.tariff_cache.version,
+                             db_api.counter_get("tariff"))
+            self.stubs.UnsetAll()
+            res = self.app_client.get("/v2/account")
+            self.assertNotEqual(json.loads(res.data), [])
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = None
+            os.close(replica_fd)
+            os.unlink(replica_filename)
+
+    def load_events(self):
+        events = []
+        for filename in ("os_amqp/instances.out.json",
+                         "os_amqp/local_volumes.out.json"):
+            events.extend(self.json_load_from_file(filename))
+        return events
+
+    def test_events(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        self.create_accounts()
+        self.create_tariffs()
+        events = self.load_events()
+        events.append({"rtype": "nova/instance", "account": "1"})
+        res = self.app_client.post(
+            "/v2/events",
+            data=json.dumps({"events": events, "atomic": False}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        results = json.loads(res.data)["events"]
+        self.assertEqual(len(results), len(events))
+        self.assertEqual([ret["status"] for ret in results],
+                         [200] * (len(events) - 1) + [400])
+        self.feed_requests("rest.v2/report_get.json")
+        self.stubs.UnsetAll()
+
+    def test_events_errors(self):
+        self.create_accounts()
+        events = [{"rtype": "nova/volume", "name": "valid",
+                   "account": "systenant", "linear": 1,
+                   "datetime": "2011-01-02T00:00:00Z"},
+                  {"rtype": "nova/volume", "name": "invalid",
+                   "account": "systenant", "linear": "abc",
+                   "datetime": "2011-01-02T00:00:00Z"},
+                  {"rtype": "nova/volume", "name": "failing",
+                   "account": "systenant", "linear": 1,
+                   "datetime": "2011-01-02T00:00:00Z"}]
+        event_apply = rest.event_apply
+
+        def fake_event_apply(rj, tariffs):
+            if rj["name"] == "failing":
+                raise RuntimeError("database is gone")
+            return event_apply(rj, tariffs)
+
+        self.stubs.Set(rest, "event_apply", fake_event_apply)
+        res = self.app_client.post(
+            "/v2/events",
+            data=json.dumps({"events": events, "atomic": False}),
+            content_type=utils.ContentType.JSON)
+        self.stubs.UnsetAll()
+        self.assertSuccess(res)
+        self.assertEqual([ret["status"]
+                          for ret in json.loads(res.data)["events"]],
+                         [200, 400, 500])
+        res = self.app_client.get("/v2/resource")
+        self.assertSuccess(res)
+        self.assertEqual([rsrc["name"] for rsrc in json.loads(res.data)],
+                         ["valid"])
+
+    def test_account_rename(self):
+        def post_event():
+            res = self.app_client.post(
+                "/v2/event",
+                data=json.dumps({"rtype": "nova/volume", "name": "vol",
+                                 "account": "renamed", "linear": 1,
+                                 "datetime": "2011-01-02T00:00:00Z"}),
+                content_type=utils.ContentType.JSON)
+            self.assertSuccess(res)
+
+        post_event()
+        # another Heart process renames the account
+        with app.test_request_context():
+            Account.query.filter_by(name="renamed").update(
+                {"name": "new name"})
+            db_api.counter_bump("identity")
+            db.session.commit()
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf, tariff_check_interval=0))
+        post_event()
+        self.stubs.UnsetAll()
+        res = self.app_client.get("/v2/account")
+        self.assertSuccess(res)
+        self.assertEqual(sorted(acc["name"] for acc in json.loads(res.data)),
+                         ["new name", "renamed"])
+
+    def test_events_atomic(self):
+        self.create_accounts()
+        events = self.load_events()
+        events.append({"rtype": "nova/instance", "account": "1"})
+        res = self.app_client.post(
+            "/v2/events",
+            data=json.dumps(events),
+            content_type=utils.ContentType.JSON)
+        self.assertEqual(res.status_code, 400)
+        self.assertTrue(("event %d:" % (len(events) - 1)) in res.data)
+        res = self.app_client.get("/v2/resource")
+        self.assertSuccess(res)
+        self.assertEqual(json.loads(res.data), [])
+
+    def test_events_write(self):
+        self.create_accounts()
+        events = self.load_events()
+        events.append({"rtype": "nova/instance", "account": "1"})
+        results = rest.events_write(events)
+        self.assertEqual([ret["status"] for ret in results],
+                         [200] * (len(events) - 1) + [400])
+        res = self.app_client.get("/v2/resource")
+        self.assertSuccess(res)
+        self.assertNotEqual(json.loads(res.data), [])
@@ -27,7 +27,9 @@ Tests for os-amqp
 import os
 import sys
 import json
+import shutil
 import datetime
+import tempfile
 import unittest
 import stubout
 
@@ -35,8 +37,10 @@ import stubout
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import tests
 
+from nova_billing import utils
 from nova_billing.os_amqp import amqp
 from nova_billing.os_amqp import instances
+from nova_billing.os_amqp import spool
 
 
 class TestCase(tests.TestCase):
@@ -45,15 +49,29 @@ class TestCase(tests.TestCase):
 
     def setUp(self):
         super(TestCase, self).setUp()
-        self.stubs.Set(amqp.Service, "__init__", lambda self: None)
-        self.event = self
+        test = self
+
+        def fake_init(service):
+            service.billing_heart = test
+            service.channel_lock = amqp.eventlet.semaphore.Semaphore()
+            service.workers = [amqp.Worker(service), amqp.Worker(service)]
+            service.spool = None
+            service.heart_rest = None
+
+        self.stubs.Set(amqp.Service, "__init__", fake_init)
 
     def fake_get_event_datetime(self, body):
         self.day += 1
         return datetime.datetime(2011, 1, self.day)
 
-    def create(self, req):
-        self.requests.append(req)
+    def feed(self, service, body):
+        heart_request = service.process_event(body, None)
+        if heart_request is not None:
+            self.requests.append(heart_request)
+
+    def post(self, url, body):
+        self.assertEqual(url, "/events")
+        self.requests.extend(body["events"])
 
     def fake_get_instance_flavor(self, instance_id):
         return self.flavor
@@ -62,8 +80,6 @@ class TestCase(tests.TestCase):
         self.day = 1
         self.requests = []
         service = amqp.Service()
-
-        service.billing_heart = self
         self.stubs.Set(service, "get_event_datetime", self.fake_get_event_datetime)
         self.stubs.Set(instances, "get_instance_flavor", self.fake_get_instance_flavor)
 
@@ -72,17 +88,17 @@ class TestCase(tests.TestCase):
         any_instance_body = json_in["any"]
         self.flavor = run_instance_body["args"]["request_spec"]["instance_type"]
 
-        service.process_event(run_instance_body, None)
+        self.feed(service, run_instance_body)
         for method in ("stop_instance", "start_instance",
                        "pause_instance", "unpause_instance",
                        "suspend_instance", "resume_instance",
                        "terminate_instance"):
             any_instance_body["method"] = method
-            service.process_event(any_instance_body, None)
-        service.process_event(run_instance_body, None)
+            self.feed(service, any_instance_body)
+        self.feed(service, run_instance_body)
         for method in ("stop_instance", "start_instance"):
             any_instance_body["method"] = method
-            service.process_event(any_instance_body, None)
+            self.feed(service, any_instance_body)
 
         self.stubs.UnsetAll()
         self.json_check_with_file(self.requests,
@@ -92,16 +108,193 @@ class TestCase(tests.TestCase):
         self.day = 1
         self.requests = []
         service = amqp.Service()
-
-        service.billing_heart = self
         self.stubs.Set(service, "get_event_datetime", self.fake_get_event_datetime)
         self.stubs.Set(instances, "get_instance_flavor", self.fake_get_instance_flavor)
 
         json_in = self.json_load_from_file("os_amqp/local_volumes.in.json")
 
         for event in json_in:
-            service.process_event(event, None)
+            self.feed(service, event)
 
         self.stubs.UnsetAll()
         self.json_check_with_file(self.requests,
             "os_amqp/local_volumes.out.json")
+
+    def test_amqp_instance_flavors(self):
+        json_in = self.json_load_from_file("os_amqp/instances.in.json")
+        run_instance_body = json_in["run"]
+        any_instance_body = json_in["any"]
+        self.stubs.Set(instances, "get_compute", None)
+        instances.create_heart_request("run_instance", run_instance_body)
+        # get_compute is not called for a known instance
+        heart_request = instances.create_heart_request(
+            "pause_instance", any_instance_body)
+        self.assertEqual(heart_request["children"],
+                         [{"rtype": "memory_mb", "linear": 2048},
+                          {"rtype": "vcpus", "linear": 0}])
+
+    def test_amqp_instance_resize(self):
+        json_in = self.json_load_from_file("os_amqp/instances.in.json")
+        run_instance_body = json_in["run"]
+        any_instance_body = json_in["any"]
+        self.flavor = instances.no_flavor
+        self.stubs.Set(instances, "get_instance_flavor",
+                       self.fake_get_instance_flavor)
+        instances.create_heart_request("run_instance", run_instance_body)
+        instance_id = instances.get_instance_id(any_instance_body)
+        self.assertTrue(instance_id in instances.instance_flavors)
+        instances.create_heart_request("finish_resize", any_instance_body)
+        self.assertFalse(instance_id in instances.instance_flavors)
+        # the new flavor is loaded from Nova
+        heart_request = instances.create_heart_request(
+            "pause_instance", any_instance_body)
+        self.assertEqual(heart_request["children"],
+                         [{"rtype": "memory_mb", "linear": 0},
+                          {"rtype": "vcpus", "linear": 0}])
+
+    def test_amqp_batch_ack(self):
+        self.requests = []
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf, heart_batch_size=2))
+        service = amqp.Service()
+        worker = service.workers[0]
+        acked = []
+
+        class FakeMessage(object):
+            def ack(message):
+                acked.append(message)
+
+        first, second = FakeMessage(), FakeMessage()
+        worker.add({"name": "1"}, first)
+        self.assertEqual((acked, self.requests), ([], []))
+        worker.add({"name": "2"}, second)
+        self.assertEqual(acked, [first, second])
+        self.assertEqual(self.requests, [{"name": "1"}, {"name": "2"}])
+        self.assertEqual(worker.buffer, [])
+
+    def test_amqp_batch_rejected(self):
+        service = amqp.Service()
+        worker = service.workers[0]
+        settled = []
+
+        def fake_post(heart_requests):
+            raise amqp.Rejected("invalid events")
+
+        self.stubs.Set(service, "post", fake_post)
+        self.stubs.Set(service, "settle",
+                       lambda messages, accepted: settled.append(accepted))
+        worker.add({"name": "1"}, None)
+        worker.flush()
+        self.assertEqual(settled, [True])
+
+    def test_amqp_event_datetime(self):
+        service = amqp.Service()
+        body = self.json_load_from_file("os_amqp/instances.in.json")["run"]
+        self.assertEqual(service.get_event_datetime(body),
+                         datetime.datetime(2011, 12, 6, 19, 12, 57))
+        del body["_context_timestamp"]
+        self.stubs.Set(utils, "now", lambda: datetime.datetime(2012, 1, 1))
+        self.assertEqual(service.get_event_datetime(body),
+                         datetime.datetime(2012, 1, 1))
+
+    def test_amqp_worker_for(self):
+        service = amqp.Service()
+        names = [str(i) for i in xrange(10)]
+        workers = [service.worker_for({"name": name}) for name in names]
+        self.assertEqual(
+            workers, [service.worker_for({"name": name}) for name in names])
+        self.assertEqual(set(workers), set(service.workers))
+
+    def test_amqp_spool(self):
+        self.requests = []
+        spool_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(spool_dir, "os-amqp.spool")
+            service = amqp.Service()
+            service.spool = spool.Spool(filename)
+            self.stubs.Set(service, "post", lambda heart_requests: False)
+            self.stubs.Set(amqp.time, "sleep", lambda seconds: None)
+            acked = []
+
+            class FakeMessage(object):
+                def ack(message):
+                    acked.append(message)
+
+            worker = service.workers[0]
+            for name in ("1", "2", "3"):
+                worker.add({"name": name}, FakeMessage())
+            worker.flush()
+            self.assertEqual(len(acked), 3)
+
+            heart_requests, offset = service.spool.read(2)
+            self.assertEqual(heart_requests, [{"name": "1"}, {"name": "2"}])
+            service.spool.commit(offset, len(heart_requests))
+            reopened = spool.Spool(filename)
+            self.assertEqual(len(reopened), 1)
+            heart_requests, offset = reopened.read(2)
+            self.assertEqual(heart_requests, [{"name": "3"}])
+            reopened.commit(offset, len(heart_requests))
+            self.assertEqual(
+                (len(reopened), os.path.getsize(filename)), (0, 0))
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_amqp_spool_corrupt(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(spool_dir, "os-amqp.spool")
+            with open(filename, "wb") as spool_file:
+                spool_file.write('{"name": "1"}\n{"na\n{"name": "2"}\n{"name"')
+            reopened = spool.Spool(filename)
+            reopened.append([{"name": "3"}])
+            self.assertEqual(len(reopened), 5)
+            replayed = []
+            while len(reopened):
+                heart_requests, offset = reopened.read(10)
+                replayed.extend(heart_requests)
+                reopened.commit(offset, len(heart_requests))
+            self.assertEqual(replayed,
+                             [{"name": "1"}, {"name": "2"}, {"name": "3"}])
+            self.assertEqual(reopened.stats()["rejected"], 2)
+            with open(reopened.rejected_filename, "rb") as rejected_file:
+                self.assertEqual(rejected_file.read(), '{"na\n{"name"\n')
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_amqp_spool_rejected(self):
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf, heart_batch_size=1))
+        self.stubs.Set(amqp.time, "sleep", lambda seconds: None)
+        spool_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(spool_dir, "os-amqp.spool")
+            service = amqp.Service()
+            service.spool = spool.Spool(filename)
+            service.spool.append([{"name": "bad"}, {"name": "good"}])
+            posted = []
+            heart_down = [True]
+
+            class HttpError(Exception):
+                code = 400
+
+            class FakeHeart(object):
+                def post(heart, url, body):
+                    if heart_down[0]:
+                        raise amqp.socket.error("connection refused")
+                    if body["events"][0]["name"] == "bad":
+                        raise HttpError("invalid events")
+                    posted.extend(body["events"])
+
+            service.billing_heart = FakeHeart()
+            service.replay_batch()
+            self.assertEqual((len(service.spool), posted), (2, []))
+            heart_down[0] = False
+            service.replay_batch()
+            service.replay_batch()
+            self.assertEqual((len(service.spool), posted),
+                             (0, [{"name": "good"}]))
+            with open(service.spool.rejected_filename, "rb") as rejected_file:
+                self.assertEqual(json.loads(rejected_file.read()),
+                                 {"name": "bad"})
+        finally:
+            shutil.rmtree(spool_dir)
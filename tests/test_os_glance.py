@@ -0,0 +1,147 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Nova Billing
+# Copyright (C) 2010-2012 Grid Dynamics Consulting Services, Inc
+# All Rights Reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for os-glance
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import shutil
+import socket
+import tempfile
+import unittest
+import stubout
+
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import utils
+from nova_billing import os_glance
+
+
+class FakeHeart(object):
+    """
+    Heart client recording posted batches. It is down while
+    ``down`` is set and rejects batches with events named ``bad``.
+    """
+    def __init__(self):
+        self.batches = Queue.Queue()
+        self.down = False
+
+    def post(self, url, body):
+        if self.down:
+            raise socket.error("connection refused")
+        if [event for event in body["events"] if event["name"] == "bad"]:
+            raise HttpError("invalid events")
+        self.batches.put(body["events"])
+
+    def posted(self):
+        batches = []
+        while not self.batches.empty():
+            batches.append(self.batches.get())
+        return batches
+
+
+class HttpError(Exception):
+    code = 400
+
+
+class FakeThread(object):
+    def __init__(self, target):
+        pass
+
+    def start(self):
+        pass
+
+
+class TestCase(tests.TestCase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.heart = FakeHeart()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+        super(TestCase, self).tearDown()
+
+    def set_conf(self, **kwargs):
+        self.stubs.Set(utils.GlobalConf, "_conf",
+                       dict(utils.global_conf._conf, **kwargs))
+
+    def test_glance_batch_size(self):
+        self.set_conf(heart_batch_size=2, heart_batch_interval=60,
+                      glance_spool_file="")
+        reporter = os_glance.HeartReporter(self.heart)
+        reporter.put({"name": "1"})
+        reporter.put({"name": "2"})
+        self.assertEqual(self.heart.batches.get(timeout=5),
+                         [{"name": "1"}, {"name": "2"}])
+
+    def test_glance_batch_interval(self):
+        self.set_conf(heart_batch_size=100, heart_batch_interval=0.1,
+                      glance_spool_file="")
+        reporter = os_glance.HeartReporter(self.heart)
+        put_at = time.time()
+        reporter.put({"name": "1"})
+        self.assertEqual(self.heart.batches.get(timeout=5), [{"name": "1"}])
+        self.assertTrue(time.time() - put_at >= 0.1)
+
+    def test_glance_spool(self):
+        filename = os.path.join(self.spool_dir, "os-glance.spool")
+        self.set_conf(heart_batch_size=10, glance_spool_file=filename)
+        self.stubs.Set(os_glance.threading, "Thread", FakeThread)
+        reporter = os_glance.HeartReporter(self.heart)
+
+        self.heart.down = True
+        reporter.send([{"name": "1"}])
+        reporter.send([{"name": "2"}])
+        self.assertEqual(len(reporter.spool), 2)
+        self.assertEqual(self.heart.posted(), [])
+
+        self.heart.down = False
+        reporter.send([{"name": "3"}])
+        self.assertEqual(len(reporter.spool), 0)
+        self.assertEqual(self.heart.posted(),
+                         [[{"name": "1"}, {"name": "2"}, {"name": "3"}]])
+
+    def test_glance_spool_rejected(self):
+        filename = os.path.join(self.spool_dir, "os-glance.spool")
+        self.set_conf(heart_batch_size=1, glance_spool_file=filename)
+        self.stubs.Set(os_glance.threading, "Thread", FakeThread)
+        reporter = os_glance.HeartReporter(self.heart)
+
+        self.heart.down = True
+        reporter.send([{"name": "bad"}])
+        reporter.send([{"name": "1"}])
+        self.heart.down = False
+        reporter.replay()
+        self.assertEqual(len(reporter.spool), 0)
+        self.assertEqual(self.heart.posted(), [[{"name": "1"}]])
+        reporter.send([{"name": "bad"}])
+        with open(reporter.spool.rejected_filename, "rb") as rejected_file:
+            self.assertEqual([json.loads(line) for line in rejected_file],
+                             [{"name": "bad"}, {"name": "bad"}])
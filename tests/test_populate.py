@@ -0,0 +1,79 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Nova Billing
+# Copyright (C) 2010-2012 Grid Dynamics Consulting Services, Inc
+# All Rights Reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for nova-billing-populate
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy.engine.reflection import Inspector
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import populate
+from nova_billing.heart import app
+from nova_billing.heart.database import db
+from nova_billing.heart.database.models import Account
+
+
+class TestCase(tests.TestCase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.db_fd, self.db_filename = tempfile.mkstemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////" + self.db_filename
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_filename)
+        super(TestCase, self).tearDown()
+
+    def name_index_unique(self):
+        for index in Inspector.from_engine(db.engine).get_indexes("account"):
+            if index["name"] == "ix_account_name":
+                return bool(index["unique"])
+
+    def test_upgrade_unique(self):
+        # a database created before account names became unique
+        db.engine.execute("DROP INDEX ix_account_name")
+        db.engine.execute("CREATE INDEX ix_account_name ON account (name)")
+        db.session.add_all([Account(name="dup"), Account(name="dup")])
+        db.session.commit()
+        populate.upgrade()
+        self.assertFalse(self.name_index_unique())
+        Account.query.filter_by(name="dup").first().name = "other"
+        db.session.commit()
+        populate.upgrade()
+        self.assertTrue(self.name_index_unique())
+
+
+if __name__ == "__main__":
+    unittest.main()